@@ -52,7 +52,8 @@ class ExtendedImageFolder_online(ImageFolderSafe):
         self.subsequent_steps = subsequent_steps
         self.single_crop = single_crop
         self.start_index = start_index
-        self.steps_per_example = [self.initial_steps] + [self.subsequent_steps] * (len(self.samples) - 1)
+        # The stream starts at start_index, with initial_steps on its first image.
+        self.steps_per_example = [self.initial_steps] + [self.subsequent_steps] * (len(self.samples) - start_index - 1)
 
     def __len__(self):
         # Calculate total length considering varying steps per example
@@ -71,6 +72,7 @@ class ExtendedImageFolder_online(ImageFolderSafe):
             if index < cumulative_steps:
                 break
             real_index += 1
+        real_index += self.start_index
 
         if self.minimizer is not None:
             real_index = self.minimizer[real_index]
@@ -147,11 +149,11 @@ class ExtendedImageFolder_online_shuffle(datasets.ImageFolder):
         rng = np.random.default_rng(shuffle_seed)
         self.indices = rng.permutation(len(self.samples))
 
-        # Assign steps per example
-        self.steps_per_example = [self.initial_steps] + [self.subsequent_steps] * (len(self.samples) - 1)
+        # Assign steps per example, the stream starts at start_index
+        self.steps_per_example = [self.initial_steps] + [self.subsequent_steps] * (len(self.samples) - start_index - 1)
 
-        # Compute cumulative steps for efficient index mapping
-        self.cumulative_steps = np.cumsum(np.array(self.steps_per_example)[self.indices])
+        # Compute cumulative steps for efficient index mapping, in stream order so that the first image gets initial_steps
+        self.cumulative_steps = np.cumsum(self.steps_per_example)
 
     def get_shuffled_indices(self) -> list:
         """
@@ -176,7 +178,7 @@ class ExtendedImageFolder_online_shuffle(datasets.ImageFolder):
             Tuple[Any, Any]: Transformed sample and its target class.
         """
         # Find the index of the cumulative step
-        real_index = np.searchsorted(self.cumulative_steps, index // self.batch_size, side="right")
+        real_index = np.searchsorted(self.cumulative_steps, index // self.batch_size, side="right") + self.start_index
         shuffled_real_index = self.indices[real_index]
 
         # Optionally print the original index
@@ -8,10 +8,12 @@
 # DeiT: https://github.com/facebookresearch/deit
 # BEiT: https://github.com/microsoft/unilm/tree/master/beit
 # --------------------------------------------------------
+import collections
+import hashlib
+import itertools
 import math
 import sys
 from typing import Iterable
-import copy
 import torch
 import models_mae_shared
 import os.path
@@ -21,7 +23,14 @@ import util.misc as misc
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
 import timm.optim.optim_factory as optim_factory
 import glob
-from utils import display_images, apply_mask_to_image
+import time
+from util.snapshot import ParameterSnapshot, SnapshotRing, zero_optimizer_state_
+from util.latent_store import LatentStore
+from util.journal import ExampleJournal
+from util.warm_start import WarmStartCache
+from util.burst_cache import BurstCache
+from util.ttt_schedule import parse_eval_schedule, parse_mask_ratio_schedule, EarlyStopping, ShiftDetector, StepBudget
+from utils import AsyncImageWriter
 
 
 @torch.no_grad()
@@ -50,31 +59,512 @@ def get_prameters_from_args(model, args):
             if name.startswith('decoder') or name == 'cls_token' or name == 'mask_token':
                 p.requires_grad = False
         parameters = [p for p in model.parameters() if p.requires_grad]
+    elif args.finetune_mode == 'encoder_top_blocks':
+        depth = len(model.blocks)
+        assert 0 < args.finetune_blocks <= depth, f'finetune_blocks should be in [1, {depth}].'
+        model.num_frozen_blocks = depth - args.finetune_blocks
+        trainable = [f'blocks.{i}.' for i in range(model.num_frozen_blocks, depth)] + ['norm.']
+        for name, p in model.named_parameters():
+            if not any(name.startswith(t) for t in trainable):
+                p.requires_grad = False
+        parameters = [p for p in model.parameters() if p.requires_grad]
     return parameters
 
 
+def _autocast(precision, device):
+    """Autocast context of the forward passes: bf16 with precision 'bf16', a no-op with 'fp32'."""
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def _scaler_enabled(args, device):
+    """Gradient scaling is only needed by fp32 weights on cuda; bf16 keeps the fp32 exponent range."""
+    return device.type == 'cuda' and args.precision != 'bf16'
+
+
+def _measure_step_time(model, samples, args, device, repeats=3, precision=None):
+    """Median time of a forward and backward pass of the MAE loss. The weights are not updated."""
+    times = []
+    for _ in range(repeats):
+        start = _synchronized_time(device)
+        with _autocast(precision or args.precision, device):
+            loss_dict, _, _, _, _ = model(samples, None, mask_ratio=args.mask_ratio)
+        torch.stack([loss_dict[l] for l in loss_dict]).sum().backward()
+        times.append(_synchronized_time(device) - start)
+    model.zero_grad(set_to_none=True)
+    return float(np.median(times))
+
+
+def _measure_phase_times(model, samples, test_samples, test_label, args, device, repeats=3):
+    """Median times of the forward and of the backward pass of the MAE loss, and of the evaluation forward.
+    The weights are not updated."""
+    times = collections.defaultdict(list)
+    for _ in range(repeats):
+        start = _synchronized_time(device)
+        with _autocast(args.precision, device):
+            loss_dict, _, _, _, _ = model(samples, None, mask_ratio=args.mask_ratio)
+        loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
+        forward_end = _synchronized_time(device)
+        loss.backward()
+        backward_end = _synchronized_time(device)
+        with torch.no_grad():
+            _evaluate_example(model, test_samples, test_label, args)
+        times['forward'].append(forward_end - start)
+        times['backward'].append(backward_end - forward_end)
+        times['eval'].append(_synchronized_time(device) - backward_end)
+    model.zero_grad(set_to_none=True)
+    return {phase: float(np.median(t)) for phase, t in times.items()}
+
+
+def _measure_depth_saving(model, samples, args, device):
+    """Step time of the current finetune mode and of a full depth 'encoder' finetuning on the same crops."""
+    num_frozen_blocks = model.num_frozen_blocks
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    partial_time = _measure_step_time(model, samples, args, device)
+    model.num_frozen_blocks = 0
+    for name, p in model.named_parameters():
+        p.requires_grad = not name.startswith('decoder') and not name.endswith('pos_embed')
+    full_time = _measure_step_time(model, samples, args, device)
+    model.num_frozen_blocks = num_frozen_blocks
+    for p, r in zip(model.parameters(), requires_grad):
+        p.requires_grad = r
+    return partial_time, full_time
+
+
+def _measure_precision_speedup(model, samples, args, device):
+    """Step time of the current precision and of fp32 on the same crops."""
+    return _measure_step_time(model, samples, args, device), _measure_step_time(model, samples, args, device, precision='fp32')
+
+
+def _measure_frozen_dtype_speedup(model, samples, args, device):
+    """Step time with the frozen modules in bf16 and with them back in fp32 on the same crops.
+    The frozen weights go through fp32 and back to bf16 without any rounding."""
+    step_time = _measure_step_time(model, samples, args, device)
+    _set_frozen_dtype(model, torch.float32)
+    fp32_step_time = _measure_step_time(model, samples, args, device)
+    _set_frozen_dtype(model, torch.bfloat16)
+    return step_time, fp32_step_time
+
+
+def _measure_resolution_speedup(model, samples, args, device):
+    """Step time on the reduced resolution crops and on the same crops upsampled to args.input_size."""
+    full_samples = torch.nn.functional.interpolate(samples, size=(args.input_size, args.input_size), mode='bicubic', align_corners=False)
+    return _measure_step_time(model, samples, args, device), _measure_step_time(model, full_samples, args, device)
+
+
+def _measure_step_times(model, dataset_train, index, test_samples, test_label, args, device):
+    """The step time comparisons requested by args, by name, all measured on the crops dataset_train[index].
+    The crops are only loaded if a comparison is requested."""
+    resolution = bool(args.adapt_input_size) and args.adapt_input_size != args.input_size
+    if not (args.finetune_mode == 'encoder_top_blocks' or args.precision != 'fp32' or args.frozen_dtype != 'fp32'
+            or resolution or args.step_time_breakdown):
+        return {}
+    samples = dataset_train[index][0].to(device)
+    step_times = {}
+    if args.finetune_mode == 'encoder_top_blocks':
+        step_times['depth'] = _measure_depth_saving(model, samples, args, device)
+    if args.precision != 'fp32':
+        step_times['precision'] = _measure_precision_speedup(model, samples, args, device)
+    if args.frozen_dtype != 'fp32':
+        step_times['frozen_dtype'] = _measure_frozen_dtype_speedup(model, samples, args, device)
+    if resolution:
+        step_times['resolution'] = _measure_resolution_speedup(model, samples, args, device)
+    if args.step_time_breakdown:
+        step_times['phases'] = _measure_phase_times(model, samples, test_samples, test_label, args, device)
+    return step_times
+
+
+def _build_clone_model(args, num_classes):
+    if args.model == 'mae_vit_small_patch16':
+        classifier_depth = 8
+        classifier_embed_dim = 512
+        classifier_num_heads = 16
+    else:
+        assert ('mae_vit_huge_patch14' in args.model or args.model == 'mae_vit_large_patch16')
+        classifier_embed_dim = 768
+        classifier_depth = 12
+        classifier_num_heads = 12
+    return models_mae_shared.__dict__[args.model](num_classes=num_classes, head_type=args.head_type,
+                                                  norm_pix_loss=args.norm_pix_loss,
+                                                  classifier_depth=classifier_depth, classifier_embed_dim=classifier_embed_dim,
+                                                  classifier_num_heads=classifier_num_heads,
+                                                  rotation_prediction=False)
+
+
+# The MAE loss never reaches the classification head, so test-time training never updates it.
+_HEAD_MODULES = ('classifier_embed', 'classifier_blocks', 'classifier_norm', 'classifier_pred', 'classifier_pos_embed', 'bn', 'head')
+
+
+def _freeze_head(model):
+    """Marks the classification head parameters, which never get a gradient, as frozen."""
+    for name in _HEAD_MODULES:
+        if hasattr(model, name):
+            module = getattr(model, name)
+            for p in (module.parameters() if isinstance(module, torch.nn.Module) else [module]):
+                p.requires_grad = False
+
+
+def _share_frozen_modules(clone_model, base_model, args):
+    """Replaces the submodules and parameters of clone_model that test-time training never updates by those of
+    base_model, so that only the adapted weights are duplicated. The blocks of a ModuleList are shared one by one.
+    The shared state dict keys are kept in clone_model.shared_keys and are not reloaded on a reset."""
+    _freeze_head(clone_model)
+    get_prameters_from_args(clone_model, args)
+    frozen = lambda module: all(not p.requires_grad for p in module.parameters())
+    shared = []
+    for name, child in list(clone_model.named_children()):
+        if isinstance(child, torch.nn.ModuleList):
+            for i in range(len(child)):
+                if frozen(child[i]):
+                    child[i] = getattr(base_model, name)[i]
+                    shared.append(f'{name}.{i}.')
+        elif frozen(child):
+            setattr(clone_model, name, getattr(base_model, name))
+            shared.append(f'{name}.')
+    for name, p in list(clone_model.named_parameters(recurse=False)):
+        if not p.requires_grad:
+            setattr(clone_model, name, getattr(base_model, name))
+            shared.append(name)
+    clone_model.shared_keys = tuple(shared)
+    shared_parameters = [p for name, p in clone_model.named_parameters() if name.startswith(clone_model.shared_keys)]
+    for p in shared_parameters:
+        p.requires_grad = False
+    shared_bytes = sum(p.numel() * p.element_size() for p in shared_parameters)
+    total_bytes = sum(p.numel() * p.element_size() for p in clone_model.parameters())
+    print('Clone model: {:.1f} MB of adapted weights, {:.1f} MB ({:.0f}%) shared with the base model'.format(
+        (total_bytes - shared_bytes) / 2**20, shared_bytes / 2**20, 100 * shared_bytes / total_bytes))
+    return clone_model
+
+
+def _cast_inputs(module, inputs):
+    dtype = next(module.parameters()).dtype
+    return tuple(x.to(dtype) if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs)
+
+
+def _cast_output(module, inputs, output):
+    return output.float() if torch.is_tensor(output) and output.is_floating_point() else output
+
+
+def _frozen_tensors(clone_model):
+    """Modules with parameters and parameters shared with share_frozen, by key."""
+    for key in clone_model.shared_keys:
+        if key.endswith('.'):
+            module = clone_model.get_submodule(key[:-1])
+            if len(list(module.parameters())) > 0:
+                yield module, list(module.parameters())
+        else:
+            yield None, [getattr(clone_model, key)]
+
+
+def _set_frozen_dtype(clone_model, dtype):
+    """Converts the shared modules and parameters of clone_model to dtype, returns the number of bytes saved."""
+    saved_bytes = 0
+    for module, parameters in _frozen_tensors(clone_model):
+        saved_bytes += sum(p.numel() * (p.element_size() - torch.finfo(dtype).bits // 8) for p in parameters)
+        if module is not None:
+            module.to(dtype)
+        else:
+            parameters[0].data = parameters[0].data.to(dtype)
+    return saved_bytes
+
+
+def _cast_frozen_modules(clone_model, dtype):
+    """Stores the shared, never adapted, modules and parameters of clone_model in dtype.
+    The frozen modules cast their inputs to dtype and their outputs back to fp32, so the adapted weights and
+    the activations between the modules stay in fp32. Shared parameters are promoted where they are used."""
+    assert hasattr(clone_model, 'shared_keys'), 'Only the modules shared with share_frozen can be cast.'
+    saved_bytes = _set_frozen_dtype(clone_model, dtype)
+    for module, _ in _frozen_tensors(clone_model):
+        if module is not None:
+            # The input cast follows the dtype of the module, so it is a no-op while the module is back in fp32.
+            module.register_forward_pre_hook(_cast_inputs)
+            module.register_forward_hook(_cast_output)
+    print('Frozen modules stored in {}: {:.1f} MB saved'.format(dtype, saved_bytes / 2**20))
+
+
+def _build_optimizer(parameters, args, lr=None):
+    lr = args.lr if lr is None else lr
+    if args.optimizer_type == 'sgd':
+        optimizer = torch.optim.SGD(parameters, lr=lr, momentum=args.optimizer_momentum)
+    elif args.optimizer_type == 'adam':
+        optimizer = torch.optim.Adam(parameters, lr=lr, betas=(0.9, 0.95))
+    else:
+        assert args.optimizer_type == 'adam_w'
+        optimizer = torch.optim.AdamW(parameters, lr=lr, betas=(0.9, 0.95))
+    return optimizer
+
+
+def _load_unshared_state_dict(model, state_dict):
+    """Loads a state dict holding every key of model but the ones of the modules shared with share_frozen."""
+    shared_keys = getattr(model, 'shared_keys', ())
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    assert not unexpected_keys, f'Unexpected keys in the state dict: {unexpected_keys}'
+    expected_missing = [k for k in model.state_dict() if k.startswith(shared_keys)] if shared_keys else []
+    assert sorted(missing_keys) == sorted(expected_missing), \
+        f'Missing keys in the state dict: {sorted(set(missing_keys) - set(expected_missing))}, ' \
+        f'shared keys in the state dict: {sorted(set(expected_missing) - set(missing_keys))}'
+
+
 def _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device):
     if args.stored_latents:
         # We don't need to change the model, as it is never changed
         base_model.train(True)
         base_model.to(device)
         return base_model, base_optimizer, base_scalar
-    clone_model.load_state_dict(copy.deepcopy(base_model.state_dict()))
+    shared_keys = getattr(clone_model, 'shared_keys', ())
+    # The shared modules are the ones of base_model: only the adapted weights are reloaded.
+    _load_unshared_state_dict(clone_model, {k: v for k, v in base_model.state_dict().items() if not k.startswith(shared_keys)})
     clone_model.train(True)
     clone_model.to(device)
-    if args.optimizer_type == 'sgd':
-        optimizer = torch.optim.SGD(get_prameters_from_args(clone_model, args), lr=args.lr, momentum=args.optimizer_momentum)
-    elif args.optimizer_type == 'adam':
-        optimizer = torch.optim.Adam(get_prameters_from_args(clone_model, args), lr=args.lr, betas=(0.9, 0.95))
-    else:
-        assert args.optimizer_type == 'adam_w'
-        optimizer = torch.optim.AdamW(get_prameters_from_args(clone_model, args), lr=args.lr, betas=(0.9, 0.95))
+    optimizer = _build_optimizer(get_prameters_from_args(clone_model, args), args)
     optimizer.zero_grad()
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=_scaler_enabled(args, device))
     if args.load_loss_scalar:
         loss_scaler.load_state_dict(base_scalar.state_dict())
     return clone_model, optimizer, loss_scaler
 
+def _save_eval_steps(args, eval_steps):
+    with open(os.path.join(args.output_dir, 'eval_steps.npy'), 'wb') as f:
+        np.save(f, np.array(eval_steps))
+
+
+def _mask_ratio_schedule(model, args, num_steps):
+    """Mask ratio of every optimizer step of an example. With args.mask_ratio_schedule 'flops:TARGET', every step uses
+    the lowest mask ratio for which the forward pass costs at most TARGET times the one at args.mask_ratio."""
+    num_patches = ((args.adapt_input_size or args.input_size) // model.patch_embed.patch_size[0]) ** 2
+    if not args.mask_ratio_schedule.startswith('flops:'):
+        return parse_mask_ratio_schedule(args.mask_ratio_schedule, num_steps, args.mask_ratio)
+    budget = float(args.mask_ratio_schedule.split(':')[1]) * model.forward_flops(num_patches, args.mask_ratio)
+    # The ratio of num_kept tokens, rounded so that num_kept_tokens gives back num_kept.
+    ratio = lambda num_kept: 1 - (num_kept + .5) / num_patches
+    num_kept = max([k for k in range(1, num_patches) if model.forward_flops(num_patches, ratio(k)) <= budget], default=1)
+    return [ratio(num_kept)] * num_steps
+
+
+def _log_mask_ratio_schedule(model, mask_ratios, args):
+    """Prints the mask ratio, the encoder tokens and the relative cost of every step, and saves them to mask_ratios.npy."""
+    num_patches = ((args.adapt_input_size or args.input_size) // model.patch_embed.patch_size[0]) ** 2
+    tokens = [model.num_kept_tokens(num_patches, r) for r in mask_ratios]
+    flops = [model.forward_flops(num_patches, r) / model.forward_flops(num_patches, args.mask_ratio) for r in mask_ratios]
+    print('Mask ratio schedule ({}): {}'.format(args.mask_ratio_schedule, ', '.join(
+        '{:.3f} ({} tokens)'.format(r, t) for r, t in zip(mask_ratios, tokens))))
+    print('Encoder tokens per step: {:.1f} on average vs {} with mask_ratio {}, forward FLOPs {:.2f}x'.format(
+        np.mean(tokens), model.num_kept_tokens(num_patches, args.mask_ratio), args.mask_ratio, np.mean(flops)))
+    with open(os.path.join(args.output_dir, 'mask_ratios.npy'), 'wb') as f:
+        np.save(f, np.array([mask_ratios, tokens]))
+
+
+def _load_eval_steps(args):
+    eval_steps_file = os.path.join(args.output_dir, 'eval_steps.npy')
+    if not os.path.exists(eval_steps_file):
+        return list(range(args.steps_per_example))
+    return np.load(eval_steps_file).tolist()
+
+
+def _seed(*keys):
+    return int(np.random.SeedSequence(list(keys)).generate_state(1)[0])
+
+
+class _SeededCrops(torch.utils.data.Dataset):
+    """Training crops whose random augmentations only depend on seed and on the crop index in the whole dataset.
+    An example is then adapted on the same crops whatever the engine, the order of the examples or the resume point."""
+    def __init__(self, dataset, seed):
+        self.dataset = dataset
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(_seed(self.seed, index + self.dataset.start_index * self.dataset.steps_per_example))
+            return self.dataset[index]
+
+
+def _example_mask(seed, example, step, num_crops, num_patches):
+    """Patch order (ids_shuffle of random_masking) of the crops of a step of an example, drawn from
+    (seed, example, step) only, so that the sequential and the batched engines mask the same patches."""
+    generator = torch.Generator().manual_seed(_seed(seed, example, step))
+    return torch.argsort(torch.rand(num_crops, num_patches, generator=generator), dim=1)
+
+
+class _ExampleSampler(torch.utils.data.Sampler):
+    """Indices of the training batches of a single example, set by `example` before every iteration.
+    Iterating one example at a time lets the adaptation stop early without loading the remaining batches."""
+    def __init__(self, steps_per_example):
+        self.steps_per_example = steps_per_example
+        self.example = 0
+
+    def __iter__(self):
+        return iter(range(self.example * self.steps_per_example, (self.example + 1) * self.steps_per_example))
+
+    def __len__(self):
+        return self.steps_per_example
+
+
+@torch.no_grad()
+def _evaluate_example(model, test_samples, test_label, args):
+    """Top-1 accuracy (0 or 100) of the model on a test example, and its classification loss."""
+    model.eval()
+    # Eval mode is deterministic, so a single forward gives the prediction.
+    with _autocast(args.precision, test_samples.device):
+        loss_d, _, _, pred, _ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
+    model.train()
+    return (pred.argmax(axis=1)[0] == test_label[0]).item() * 100., loss_d['classification']
+
+
+@torch.no_grad()
+def _unadapted_prediction(model, test_samples, test_label, args):
+    """Class probabilities of the un-adapted model on a test example, their entropy and the encoder cls embedding."""
+    model.eval()
+    with _autocast(args.precision, test_samples.device):
+        _, _, cls_feature, pred, _ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
+    model.train()
+    probs = pred[0].float().softmax(-1)
+    return probs, -(probs * probs.clamp_min(1e-12).log()).sum().item(), cls_feature[0]
+
+
+def _gate_example(probs, entropy, test_label, args):
+    """Top-1 accuracy (0 or 100) of the un-adapted prediction, and whether it is confident enough to skip
+    the adaptation: a max probability above, or an entropy below, confidence_threshold."""
+    if args.confidence_gate == 'entropy':
+        confident = entropy <= args.confidence_threshold
+    else:
+        assert args.confidence_gate == 'max_prob'
+        confident = probs.max().item() >= args.confidence_threshold
+    return (probs.argmax() == test_label[0]).item() * 100., confident
+
+
+def _sync_free_buffers(max_steps, device):
+    """Device buffers for the per-step losses, the predictions and the non-finite flag of an example."""
+    return (torch.zeros(max_steps, device=device), torch.zeros(max_steps, dtype=torch.long, device=device),
+            torch.zeros((), dtype=torch.bool, device=device))
+
+
+def _adapt_example_sync_free(model, optimizer, train_loader, test_samples, test_label, num_micro_steps, eval_steps, args, device,
+                             buffers, metric_logger, after_step=None, mask_ratios=None, example=None, first_forward=None):
+    """Adapts the model on one example without any device to host synchronization inside the loop.
+
+    The loss of every optimizer step and the predictions after the steps of eval_steps are written to
+    preallocated device buffers and copied to the host once at the end, as is the non-finite flag.
+    The loss scaler is not used: the adaptation runs without gradient scaling, and a non-finite loss stops the run.
+    first_forward: crops and outputs of the forward of the first step when it was already run (see _shift_signals).
+    Returns the host arrays of the losses and of the predicted classes.
+    """
+    accum_iter = args.accum_iter
+    step_losses, step_preds, nonfinite = buffers
+    eval_index = {step: i for i, step in enumerate(eval_steps)}
+    nonfinite.zero_()
+    for step_per_example in range(num_micro_steps):
+        if step_per_example == 0 and first_forward is not None:
+            loss_dict = first_forward[2][0]
+            first_forward = None
+        else:
+            samples, _ = next(train_loader)
+            samples = samples.to(device, non_blocking=True)[0]
+            # With the index of the example, the masks are the ones of train_on_test (see _example_mask).
+            input_mask = None if example is None else _example_mask(args.seed, example, step_per_example, len(samples),
+                                                                    (samples.shape[-1] // model.patch_embed.patch_size[0]) ** 2)
+            with _autocast(args.precision, device):
+                loss_dict, _, _, _, _ = model(samples, None, input_mask=input_mask,
+                                              mask_ratio=args.mask_ratio if mask_ratios is None else mask_ratios[step_per_example // accum_iter])
+        loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
+        nonfinite |= ~torch.isfinite(loss)
+        (loss / accum_iter).backward()
+        if (step_per_example + 1) % accum_iter == 0:
+            optimizer.step()
+            optimizer.zero_grad()
+            step = step_per_example // accum_iter
+            step_losses[step] = loss.detach()
+            if step in eval_index:
+                with torch.no_grad():
+                    model.eval()
+                    with _autocast(args.precision, device):
+                        _, _, _, pred, _ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
+                    step_preds[eval_index[step]] = pred.argmax(axis=1)[0]
+                    model.train()
+        if after_step is not None:
+            after_step(step_per_example)
+    num_steps = num_micro_steps // accum_iter
+    wait_start = time.time()
+    host = torch.cat([step_losses[:num_steps], step_preds[:len(eval_steps)].float(), nonfinite.float().view(1)]).cpu().numpy()
+    metric_logger.update(host_wait_time=time.time() - wait_start)
+    if host[-1]:
+        print("Loss is not finite, stopping training")
+        sys.exit(1)
+    return host[:num_steps], host[num_steps:-1].astype(np.int64)
+
+
+def _journal_example(journal, data_iter_step, all_results, all_losses, steps=None, example_time=None):
+    """Appends the results of the example just adapted, the last entry of every row, to the journal."""
+    journal.append(data_iter_step, [r[-1] for r in all_results], [l[-1] for l in all_losses], steps=steps, time=example_time)
+
+
+def _record_example(journal, args, data_iter_step, dataset_len, all_results, all_losses, all_steps=None, steps=None,
+                    example_time=None):
+    """Journals the example just adapted. Every 500 examples and after the last one, saves the rows gathered since
+    the previous save into results_/losses_(/steps_){data_iter_step}.npy and empties them."""
+    _journal_example(journal, data_iter_step, all_results, all_losses, steps=steps, example_time=example_time)
+    if data_iter_step % 500 == 499 or (data_iter_step == dataset_len - 1):
+        with open(os.path.join(args.output_dir, f'results_{data_iter_step}.npy'), 'wb') as f:
+            np.save(f, np.array(all_results))
+        with open(os.path.join(args.output_dir, f'losses_{data_iter_step}.npy'), 'wb') as f:
+            np.save(f, np.array(all_losses))
+        if all_steps is not None:
+            with open(os.path.join(args.output_dir, f'steps_{data_iter_step}.npy'), 'wb') as f:
+                np.save(f, np.array(all_steps))
+            all_steps.clear()
+        for row in all_results + all_losses:
+            row.clear()
+
+
+def _read_final_accuracy(output_dir):
+    """Top1 accuracy after the last evaluated step in the accuracy.txt of output_dir, None if there is none."""
+    accuracy = None
+    accuracy_file = os.path.join(output_dir, 'accuracy.txt')
+    if os.path.exists(accuracy_file):
+        with open(accuracy_file) as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) == 2 and fields[0].isdigit():
+                    accuracy = float(fields[1])
+    return accuracy
+
+
+def _synchronized_time(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.time()
+
+
+def _snapshot_model(model, loss_scaler, args):
+    """Returns the state needed by _restore_model, or None if the model is rebuilt on every reset."""
+    if args.reset_mode != 'inplace' or args.stored_latents:
+        return None
+    return ParameterSnapshot(p for p in model.parameters() if p.requires_grad), loss_scaler.state_dict()
+
+
+def _restore_model(model, optimizer, loss_scaler, snapshot):
+    # Same result as _reinitialize_model, without allocating: one copy of the trainable weights and
+    # a zeroed optimizer state.
+    parameters, scaler_state = snapshot
+    parameters.restore()
+    zero_optimizer_state_(optimizer)
+    optimizer.zero_grad()
+    loss_scaler.load_state_dict(scaler_state)
+    model.train(True)
+    return model, optimizer, loss_scaler
+
+def _reset_model(model, optimizer, loss_scaler, snapshot, base_model, base_optimizer, base_scalar, clone_model, args, device):
+    """Resets the adapted model to the base weights: in place from snapshot, or by reloading the clone model."""
+    if snapshot is not None:
+        return _restore_model(model, optimizer, loss_scaler, snapshot)
+    return _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
+
 # def sequential_model(base_model, clone_model, args, device, previous_model_state_dict):
 
 #     clone_model.load_state_dict(previous_model_state_dict)
@@ -100,36 +590,56 @@ def train_on_test(base_model: torch.nn.Module,
                   log_writer=None,
                   args=None,
                   num_classes: int = 1000,
-                  iter_start: int = 0):
-    if args.model == 'mae_vit_small_patch16':
-        classifier_depth = 8
-        classifier_embed_dim = 512
-        classifier_num_heads = 16
-    else:
-        assert ('mae_vit_huge_patch14' in args.model or args.model == 'mae_vit_large_patch16')
-        classifier_embed_dim = 768
-        classifier_depth = 12
-        classifier_num_heads = 12
-    clone_model = models_mae_shared.__dict__[args.model](num_classes=num_classes, head_type=args.head_type,
-                                                         norm_pix_loss=args.norm_pix_loss,
-                                                         classifier_depth=classifier_depth, classifier_embed_dim=classifier_embed_dim,
-                                                         classifier_num_heads=classifier_num_heads,
-                                                         rotation_prediction=False)
+                  iter_start: int = 0,
+                  iter_end: int = None,
+                  merge_results: bool = True):
+    clone_model = _build_clone_model(args, num_classes)
+    assert args.frozen_dtype == 'fp32' or (args.share_frozen and not args.stored_latents), \
+        'frozen_dtype bf16 casts the modules shared with share_frozen, it needs share_frozen and no stored_latents.'
+    if args.share_frozen and not args.stored_latents:
+        clone_model = _share_frozen_modules(clone_model, base_model, args)
+        if args.frozen_dtype == 'bf16':
+            _cast_frozen_modules(clone_model, torch.bfloat16)
+    eval_steps = parse_eval_schedule(args.eval_schedule, args.steps_per_example)
+    eval_index = {step: i for i, step in enumerate(eval_steps)}
+    _save_eval_steps(args, eval_steps)
+    mask_ratios = _mask_ratio_schedule(clone_model, args, args.steps_per_example)
+    if args.mask_ratio_schedule != 'constant':
+        _log_mask_ratio_schedule(clone_model, mask_ratios, args)
     # Intialize the model for the current run
-    all_results = [list() for i in range(args.steps_per_example)]
+    all_results = [list() for i in range(len(eval_steps))]
     all_losses =  [list() for i in range(args.steps_per_example)]
+    all_steps = []
     metric_logger = misc.MetricLogger(delimiter="  ")
-    train_loader = iter(torch.utils.data.DataLoader(dataset_train, batch_size=1, shuffle=False, num_workers=args.num_workers))
-    val_loader = iter(torch.utils.data.DataLoader(dataset_val, batch_size=1, shuffle=False, num_workers=args.num_workers))
     accum_iter = args.accum_iter
+    example_sampler = _ExampleSampler(args.steps_per_example * accum_iter)
+    train_crops = torch.utils.data.DataLoader(_SeededCrops(dataset_train, args.seed), batch_size=1, sampler=example_sampler,
+                                              num_workers=args.num_workers, persistent_workers=args.num_workers > 0)
+    # Examples are numbered from the start index of the datasets.
+    dataset_len = len(dataset_val) if iter_end is None else iter_end
+    val_loader = iter(torch.utils.data.DataLoader(dataset_val, batch_size=1, num_workers=args.num_workers,
+                                                  sampler=range(iter_start - dataset_val.start_index, dataset_len - dataset_val.start_index)))
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    early_stopping = EarlyStopping(args.early_stop_threshold, args.early_stop_patience, args.early_stop_min_steps) if args.early_stop else None
+    # With a step budget, steps_per_example is the maximum number of steps of an example.
+    step_budget = StepBudget(args.step_budget, args.step_budget_min, args.steps_per_example, args.step_budget_window) if args.step_budget > 0 else None
+    warm_start = WarmStartCache(args.warm_start_cache, args.warm_start_threshold, args.warm_start_density) if args.warm_start_cache > 0 else None
+    journal = ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl'))
 
     model, optimizer, loss_scaler = _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
+    snapshot = _snapshot_model(model, loss_scaler, args)
+    if warm_start is not None:
+        assert snapshot is not None, 'The warm start deltas are taken against the in-place snapshot (reset_mode inplace).'
+    if args.host_sync_free:
+        assert not (args.early_stop or args.step_budget > 0 or warm_start is not None or args.print_images or args.verbose), \
+            'early_stop, step_budget, warm_start_cache, print_images and verbose need the losses on the host at every step.'
+        sync_free_buffers = _sync_free_buffers(args.steps_per_example, device)
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
-    dataset_len = len(dataset_val)
 
     if args.print_images :
+        image_writer = AsyncImageWriter(args.print_images_dir or os.path.join(args.output_dir, 'images_evolution'),
+                                        model.patch_embed.patch_size[0], args.print_images_queue)
         s = (args.steps_per_example * accum_iter - 1) / (args.num_print_images - 1)
         indices_to_show = {int(round(i * s)) for i in range(args.num_print_images - 1)}
         indices_to_show.add(args.steps_per_example * accum_iter - 1)
@@ -144,105 +654,649 @@ def train_on_test(base_model: torch.nn.Module,
         val_data = next(val_loader)
         (test_samples, test_label) = val_data
         test_samples = test_samples.to(device, non_blocking=True)[0]
+        test_label_value = int(test_label[0])
         test_label = test_label.to(device, non_blocking=True)
         pseudo_labels = None
+        example_sampler.example = data_iter_step - dataset_train.start_index
+        if early_stopping is not None:
+            early_stopping.reset()
+
+        if data_iter_step == iter_start:
+            step_times = _measure_step_times(model, dataset_train, example_sampler.example * example_sampler.steps_per_example,
+                                             test_samples, test_label, args, device)
+        example_start = _synchronized_time(device)
+        skipped = False
+        if args.confidence_gate != 'none' or step_budget is not None or warm_start is not None:
+            probs, entropy, cls_feature = _unadapted_prediction(model, test_samples, test_label, args)
+        if args.confidence_gate != 'none':
+            acc1, skipped = _gate_example(probs, entropy, test_label, args)
+            metric_logger.update(skipped=int(skipped))
+        example_budget = args.steps_per_example
+        if warm_start is not None and not skipped:
+            delta, similarity = warm_start.lookup(cls_feature)
+            if delta is not None:
+                # Start from the weights adapted on the most similar cached example, with fewer steps.
+                warm_start.add_delta_(snapshot[0].flat, delta)
+                example_budget = args.warm_start_steps
+            metric_logger.update(warm_start_hit=int(delta is not None))
+        if not skipped:
+            train_loader = iter(train_crops)
 
         # Test time training:
 
-        for step_per_example in range(args.steps_per_example):
-            train_data = next(train_loader)
-            # Train data are 2 values [image, class]
-            mask_ratio = args.mask_ratio
-            samples, _ = train_data
-            targets_rot, samples_rot = None, None
-            samples = samples.to(device, non_blocking=True)[0] # index [0] becuase the data is batched to have size 1.
-            loss_dict, pred_patches, _, _, mask = model(samples, None, mask_ratio=mask_ratio)
+        if skipped:
+            # The un-adapted prediction is the result of every step.
+            for i in range(len(eval_steps)):
+                all_results[i].append(acc1)
+            for step in range(args.steps_per_example):
+                all_losses[step].append(float('nan'))
+            metric_logger.update(top1_acc=acc1)
+            loss_value = float('nan')
+            steps_used = 0
+        elif args.host_sync_free:
+            step_losses, step_preds = _adapt_example_sync_free(model, optimizer, train_loader, test_samples, test_label,
+                                                               args.steps_per_example * accum_iter, eval_steps, args, device,
+                                                               sync_free_buffers, metric_logger, mask_ratios=mask_ratios,
+                                                               example=data_iter_step)
+            for step in range(args.steps_per_example):
+                all_losses[step].append(step_losses[step] / accum_iter)
+            for i in range(len(eval_steps)):
+                all_results[i].append((step_preds[i] == test_label_value) * 100.)
+            loss_value = float(step_losses[-1])
+            metric_logger.update(mae=float(np.mean(step_losses)))
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+            if eval_steps[-1] == args.steps_per_example - 1:
+                metric_logger.update(top1_acc=all_results[-1][-1])
+            metric_logger.update(loss=loss_value)
+            steps_used = args.steps_per_example
+        else:
+            for step_per_example in range(args.steps_per_example * accum_iter):
+                train_data = next(train_loader)
+                # Train data are 2 values [image, class]
+                mask_ratio = mask_ratios[step_per_example // accum_iter]
+                samples, _ = train_data
+                targets_rot, samples_rot = None, None
+                samples = samples.to(device, non_blocking=True)[0] # index [0] becuase the data is batched to have size 1.
+                input_mask = _example_mask(args.seed, data_iter_step, step_per_example, len(samples),
+                                           (samples.shape[-1] // model.patch_embed.patch_size[0]) ** 2)
+                with _autocast(args.precision, device):
+                    loss_dict, pred_patches, _, _, mask = model(samples, None, mask_ratio=mask_ratio, input_mask=input_mask)
+                loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
+                loss_value = loss.item()
+                loss /= accum_iter
+                if not math.isfinite(loss_value):
+                    print("Loss is {}, stopping training".format(loss_value))
+                    sys.exit(1)
+                loss_scaler(loss, optimizer, parameters=model.parameters(),
+                            update_grad=(step_per_example + 1) % accum_iter == 0)
+                if (step_per_example + 1) % accum_iter == 0:
+                    if args.verbose:
+                        print(f'datapoint {data_iter_step} iter {step_per_example}: rec_loss {loss_value}')
+
+                    all_losses[step_per_example // accum_iter].append(loss_value/accum_iter)
+                    optimizer.zero_grad()
+                    if step_budget is not None and step_per_example // accum_iter == args.step_budget_min - 1:
+                        example_budget = min(example_budget, step_budget.allocate(all_losses[0][-1], all_losses[step_per_example // accum_iter][-1], entropy))
+
+
+                metric_logger.update(**{k:v.item() for k,v in loss_dict.items()})
+                lr = optimizer.param_groups[0]["lr"]
+                metric_logger.update(lr=lr)
+                # Test:
+                # The printed snapshots of the steps that are not evaluated have no class loss.
+                cls_loss = float('nan')
+                if (step_per_example + 1) % accum_iter == 0 and step_per_example // accum_iter in eval_index:
+                    acc1, cls_loss = _evaluate_example(model, test_samples, test_label, args)
+                    if args.verbose:
+                        cls_loss = cls_loss.item()
+                        print(f'datapoint {data_iter_step} iter {step_per_example}: class_loss {cls_loss}')
+                    if (step_per_example + 1) // accum_iter == args.steps_per_example:
+                        metric_logger.update(top1_acc=acc1)
+                        metric_logger.update(loss=loss_value)
+                    all_results[eval_index[step_per_example // accum_iter]].append(acc1)
+
+                if (args.print_images) and data_iter_step % 10 == 0 :
+
+                    if (step_per_example in indices_to_show) :
+
+                        # The masking and the rendering are done by the writer process.
+                        reconstructed_img = model.unpatchify(pred_patches[0].unsqueeze(0))[0]
+                        reconstructed_imgs.append((reconstructed_img.detach().cpu(), mask[0].detach().cpu()))
+                        class_losses.append(float(cls_loss))
+                        rec_losses.append(loss_value)
+                        steps.append(step_per_example)
+
+                        if step_per_example == args.steps_per_example * accum_iter - 1 :
+                            image_writer.submit(f'image_{data_iter_step}.png', samples[0].detach().cpu(), mask[0].detach().cpu(),
+                                                reconstructed_imgs, rec_losses, class_losses, steps)
+
+                if (step_per_example + 1) % accum_iter == 0 and early_stopping is not None and early_stopping.step(loss_value):
+                    break
+                if (step_per_example + 1) // accum_iter >= example_budget:
+                    break
+
+            # After an early stop, or once the step budget of the example is spent, the model does not change
+            # anymore: the remaining evaluations are the current prediction.
+            steps_used = step_per_example // accum_iter + 1
+            if steps_used < args.steps_per_example:
+                if steps_used - 1 not in eval_index:
+                    acc1, _ = _evaluate_example(model, test_samples, test_label, args)
+                for step in range(steps_used, args.steps_per_example):
+                    if step in eval_index:
+                        all_results[eval_index[step]].append(acc1)
+                    all_losses[step].append(float('nan'))
+                metric_logger.update(top1_acc=acc1)
+                metric_logger.update(loss=loss_value)
+        all_steps.append(steps_used)
+        example_time = _synchronized_time(device) - example_start
+        metric_logger.update(steps=steps_used)
+        if step_budget is not None:
+            step_budget.record(steps_used)
+        metric_logger.update(example_time=example_time)
+        if not skipped:
+            metric_logger.update(adapted_time=example_time)
+
+        if data_iter_step % 50 == 1:
+            print('step: {}, acc {} rec-loss {}'.format(data_iter_step, np.mean(all_results[-1]), loss_value))
+        _record_example(journal, args, data_iter_step, dataset_len, all_results, all_losses, all_steps, steps=steps_used,
+                        example_time=example_time)
+        if skipped:
+            # The model was not changed.
+            continue
+        if warm_start is not None:
+            warm_start.add(cls_feature, snapshot[0].flat, snapshot[0].pristine)
+        reset_start = _synchronized_time(device)
+        model, optimizer, loss_scaler = _reset_model(model, optimizer, loss_scaler, snapshot, base_model, base_optimizer,
+                                                     base_scalar, clone_model, args, device)
+        metric_logger.update(reset_time=_synchronized_time(device) - reset_start)
+
+    journal.close()
+    if args.print_images:
+        image_writer.close()
+    if 'reset_time' in metric_logger.meters:
+        print('Mean reset time per example ({}): {:.2f} ms'.format(args.reset_mode, 1000 * metric_logger.reset_time.global_avg))
+    if args.finetune_mode == 'encoder_top_blocks' and iter_start < dataset_len:
+        partial_time, full_time = step_times['depth']
+        print('Top {}/{} blocks: step time {:.1f} ms vs {:.1f} ms full depth ({:.1f}% saving), top1 acc {:.2f}'.format(
+            args.finetune_blocks, len(model.blocks), 1000 * partial_time, 1000 * full_time,
+            100 * (1 - partial_time / full_time), metric_logger.top1_acc.global_avg))
+    if 'warm_start_hit' in metric_logger.meters:
+        print('Warm start: {:.1f}% hit rate, {:.2f} steps per example saved, top1 acc {:.2f}, {} deltas cached in {:.1f} MB of {} memory'.format(
+            100 * metric_logger.warm_start_hit.global_avg, args.steps_per_example - metric_logger.steps.global_avg,
+            metric_logger.top1_acc.global_avg, len(warm_start.entries), warm_start.memory_bytes() / 2**20, warm_start.device.type))
+    if step_budget is not None and step_budget.num_examples > 0:
+        print('Step budget: {:.2f} steps per example on average for a target of {}, top1 acc {:.2f}'.format(
+            metric_logger.steps.global_avg, args.step_budget, metric_logger.top1_acc.global_avg))
+    if 'skipped' in metric_logger.meters:
+        # Throughput gain against adapting every example, estimated from the time of the adapted ones.
+        gain = metric_logger.adapted_time.global_avg / metric_logger.example_time.global_avg if 'adapted_time' in metric_logger.meters else float('inf')
+        print('Confidence gate ({} {}): {:.1f}% of the examples skipped, {:.2f}x throughput, top1 acc {:.2f}'.format(
+            args.confidence_gate, args.confidence_threshold, 100 * metric_logger.skipped.global_avg,
+            gain, metric_logger.top1_acc.global_avg))
+    if 'example_time' in metric_logger.meters:
+        images_per_hour = 3600 / metric_logger.example_time.global_avg
+        print('Throughput ({}, {} threads): {:.0f} images/hour'.format(args.precision, torch.get_num_threads(), images_per_hour))
+        if args.step_time_breakdown:
+            # Each example runs steps_per_example * accum_iter forward and backward passes and len(eval_steps) evaluations.
+            phase_times = step_times['phases']
+            print('Step time breakdown: forward {:.1f} ms, backward {:.1f} ms, eval {:.1f} ms, {} micro-steps and {} evaluations per example'.format(
+                1000 * phase_times['forward'], 1000 * phase_times['backward'], 1000 * phase_times['eval'],
+                args.steps_per_example * accum_iter, len(eval_steps)))
+        if args.host_sync_free:
+            print('Host wait: {:.2f} ms per example'.format(1000 * metric_logger.host_wait_time.global_avg))
+        if args.precision != 'fp32':
+            step_time, fp32_step_time = step_times['precision']
+            print('Step time {:.1f} ms vs {:.1f} ms in fp32: about {:.0f} images/hour in fp32 ({:.2f}x speedup)'.format(
+                1000 * step_time, 1000 * fp32_step_time, images_per_hour * step_time / fp32_step_time, fp32_step_time / step_time))
+        if args.frozen_dtype != 'fp32':
+            step_time, fp32_step_time = step_times['frozen_dtype']
+            print('Step time with the frozen modules in {} {:.1f} ms vs {:.1f} ms in fp32 ({:.2f}x speedup)'.format(
+                args.frozen_dtype, 1000 * step_time, 1000 * fp32_step_time, fp32_step_time / step_time))
+        if args.adapt_input_size and args.adapt_input_size != args.input_size:
+            step_time, full_step_time = step_times['resolution']
+            print('Adaptation at {}px: step time {:.1f} ms vs {:.1f} ms at {}px ({:.2f}x speedup), top1 acc {:.2f}'.format(
+                args.adapt_input_size, 1000 * step_time, 1000 * full_step_time, args.input_size, full_step_time / step_time,
+                metric_logger.top1_acc.global_avg))
+    if merge_results:
+        save_accuracy_results(args)
+    # gather the stats from all processes
+    try:
+        print("Averaged stats:", metric_logger)
+        return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    except:
+        pass
+    return
+
+
+def _stack_parameters(model, num_stacked, device):
+    """Splits the model state into per-example copies of the trainable parameters,
+    stacked along a leading dimension of size num_stacked, and the shared frozen tensors."""
+    stacked, shared = {}, {}
+    for name, p in model.named_parameters():
+        if p.requires_grad:
+            stacked[name] = p.detach().to(device).unsqueeze(0).repeat(num_stacked, *([1] * p.dim())).requires_grad_()
+        else:
+            shared[name] = p.detach().to(device)
+    for name, b in model.named_buffers():
+        shared[name] = b.to(device)
+    return stacked, shared
+
+
+def _stack_batches(first_example, num_examples, group_size, steps_per_example):
+    """Batch sampler that yields, for every step, the crops of group_size consecutive test examples."""
+    for group_start in range(first_example, first_example + num_examples, group_size):
+        group = range(group_start, min(group_start + group_size, first_example + num_examples))
+        for step in range(steps_per_example):
+            yield [example * steps_per_example + step for example in group]
+
+
+def train_on_test_batched(base_model: torch.nn.Module,
+                          base_optimizer,
+                          base_scalar,
+                          dataset_train, dataset_val,
+                          device: torch.device,
+                          log_writer=None,
+                          args=None,
+                          num_classes: int = 1000,
+                          iter_start: int = 0,
+                          iter_end: int = None,
+                          merge_results: bool = True):
+    """Test time training on args.ttt_batch_examples test examples at once.
+
+    Every example keeps its own copy of the trainable weights, stacked along a leading dimension,
+    and the model is run on each copy with a vmapped functional call. Since the per-example losses are
+    independent, backpropagating their sum gives every copy exactly the gradient it would get alone,
+    and the element-wise optimizers (sgd, adam, adam_w) keep an independent state per copy.
+    The crops and the masks of an example are the ones train_on_test draws for it (see _SeededCrops and
+    _example_mask), so both engines give the same results, up to floating point differences.
+    """
+    try:
+        from torch.func import functional_call, vmap
+    except ImportError:
+        try:  # torch 1.12 and 1.13 ship vmap in functorch.
+            from functorch import vmap
+            from torch.nn.utils.stateless import functional_call
+        except ImportError:
+            raise ImportError('ttt_batch_examples > 1 needs torch >= 2.0, or torch 1.12 or 1.13 with functorch.')
+    assert not args.print_images, 'print_images is not supported with ttt_batch_examples > 1.'
+    assert not args.stored_latents, 'stored_latents is not supported with ttt_batch_examples > 1.'
+    assert not args.early_stop, 'early_stop is not supported with ttt_batch_examples > 1.'
+    assert not args.host_sync_free, 'host_sync_free is not supported with ttt_batch_examples > 1.'
+    assert args.confidence_gate == 'none', 'confidence_gate is not supported with ttt_batch_examples > 1.'
+    assert args.step_budget == 0, 'step_budget is not supported with ttt_batch_examples > 1.'
+    assert args.warm_start_cache == 0, 'warm_start_cache is not supported with ttt_batch_examples > 1.'
+    assert args.frozen_dtype == 'fp32', 'frozen_dtype bf16 is not supported with ttt_batch_examples > 1.'
+    # dataset_train yields batch_size / ttt_group_size crops per example, which only the grouped engine completes.
+    assert args.ttt_group_size == 1, 'ttt_group_size > 1 is not supported with ttt_batch_examples > 1.'
+    num_stacked = args.ttt_batch_examples
+    accum_iter = args.accum_iter
+    num_steps = args.steps_per_example * accum_iter
+    model = _build_clone_model(args, num_classes)
+    model.load_state_dict(base_model.state_dict())
+    # The head is shared by the stacked examples rather than repeated ttt_batch_examples times.
+    _freeze_head(model)
+    get_prameters_from_args(model, args)
+    model.to(device)
+
+    eval_steps = parse_eval_schedule(args.eval_schedule, args.steps_per_example)
+    eval_index = {step: i for i, step in enumerate(eval_steps)}
+    _save_eval_steps(args, eval_steps)
+    mask_ratios = _mask_ratio_schedule(model, args, args.steps_per_example)
+    if args.mask_ratio_schedule != 'constant':
+        _log_mask_ratio_schedule(model, mask_ratios, args)
+    all_results = [list() for i in range(len(eval_steps))]
+    all_losses = [list() for i in range(args.steps_per_example)]
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    dataset_len = len(dataset_val) if iter_end is None else iter_end
+    num_examples = dataset_len - iter_start
+    # Examples are numbered from the start index of the datasets.
+    train_loader = iter(torch.utils.data.DataLoader(_SeededCrops(dataset_train, args.seed), num_workers=args.num_workers,
+                                                    batch_sampler=_stack_batches(iter_start - dataset_train.start_index, num_examples,
+                                                                                 num_stacked, num_steps)))
+    val_loader = iter(torch.utils.data.DataLoader(dataset_val, num_workers=args.num_workers,
+                                                  batch_sampler=_stack_batches(iter_start - dataset_val.start_index, num_examples,
+                                                                               num_stacked, 1)))
+    journal = ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl'))
+    if log_writer is not None:
+        print('log_dir: {}'.format(log_writer.log_dir))
+
+    for group_start in range(iter_start, dataset_len, num_stacked):
+        group_size = min(num_stacked, dataset_len - group_start)
+        stacked, shared = _stack_parameters(model, group_size, device)
+        optimizer = _build_optimizer(list(stacked.values()), args)
+        optimizer.zero_grad()
+        loss_scaler = NativeScaler(enabled=_scaler_enabled(args, device))
+        if args.load_loss_scalar:
+            loss_scaler.load_state_dict(base_scalar.state_dict())
+
+        def mae_loss(params, samples, input_mask, mask_ratio):
+            loss_dict, _, _, _, _ = functional_call(model, {**params, **shared}, (samples, None),
+                                                    {'mask_ratio': mask_ratio, 'input_mask': input_mask})
+            return torch.stack([loss_dict[l] for l in loss_dict]).sum()
+
+        def classify(params, samples, label):
+            _, _, _, pred, _ = functional_call(model, {**params, **shared}, (samples, label),
+                                               {'mask_ratio': 0, 'reconstruct': False})
+            return pred
+
+        test_samples, test_label = next(val_loader)
+        test_samples = test_samples.to(device, non_blocking=True)
+        test_label = test_label.to(device, non_blocking=True)
+        group_results = [list() for i in range(len(eval_steps))]
+        group_losses = [list() for i in range(args.steps_per_example)]
+        for step_per_example in range(num_steps):
+            samples, _ = next(train_loader)
+            samples = samples.to(device, non_blocking=True)
+            num_patches = (samples.shape[-1] // model.patch_embed.patch_size[0]) ** 2
+            input_masks = torch.stack([_example_mask(args.seed, group_start + example, step_per_example, samples.shape[1], num_patches)
+                                       for example in range(group_size)]).to(device)
+            model.train()
+            with _autocast(args.precision, device):
+                losses = vmap(mae_loss, in_dims=(0, 0, 0, None))(stacked, samples, input_masks, mask_ratios[step_per_example // accum_iter])
+            loss_values = losses.detach().float().cpu().numpy()
+            if not np.isfinite(loss_values).all():
+                print("Loss is {}, stopping training".format(loss_values))
+                sys.exit(1)
+            loss_scaler(losses.sum() / accum_iter, optimizer, parameters=list(stacked.values()),
+                        update_grad=(step_per_example + 1) % accum_iter == 0)
+            metric_logger.update(mae=float(loss_values.mean()))
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+            if (step_per_example + 1) % accum_iter == 0:
+                optimizer.zero_grad()
+                group_losses[step_per_example // accum_iter] = list(loss_values / accum_iter)
+            if (step_per_example + 1) % accum_iter == 0 and step_per_example // accum_iter in eval_index:
+                # Eval mode is deterministic, so a single forward gives the prediction for every example.
+                with torch.no_grad():
+                    model.eval()
+                    with _autocast(args.precision, device):
+                        pred = vmap(classify)(stacked, test_samples, test_label.unsqueeze(1))
+                    correct = (pred[:, 0].argmax(axis=1) == test_label).cpu().numpy()
+                group_results[eval_index[step_per_example // accum_iter]] = list(correct * 100.)
+                if args.verbose:
+                    print(f'datapoints {group_start}-{group_start + group_size - 1} iter {step_per_example}: rec_loss {loss_values}')
+        metric_logger.update(top1_acc=float(np.mean(group_results[-1])))
+
+        for example in range(group_size):
+            data_iter_step = group_start + example
+            for i in range(len(eval_steps)):
+                all_results[i].append(group_results[i][example])
+            for step in range(args.steps_per_example):
+                all_losses[step].append(group_losses[step][example])
+            if data_iter_step % 50 == 1:
+                print('step: {}, acc {} rec-loss {}'.format(data_iter_step, np.mean(all_results[-1]), group_losses[-1][example]))
+            _record_example(journal, args, data_iter_step, dataset_len, all_results, all_losses)
+
+    journal.close()
+    if merge_results:
+        save_accuracy_results(args)
+    print("Averaged stats:", metric_logger)
+    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+
+
+def train_on_test_grouped(base_model: torch.nn.Module,
+                          base_optimizer,
+                          base_scalar,
+                          dataset_train, dataset_val,
+                          device: torch.device,
+                          log_writer=None,
+                          args=None,
+                          num_classes: int = 1000,
+                          iter_start: int = 0,
+                          iter_end: int = None,
+                          merge_results: bool = True):
+    """Episodic test time training on groups of args.ttt_group_size consecutive test examples.
+
+    The test examples of a group are assumed to share a domain (e.g. one ImageNet-C corruption and severity):
+    a single copy of the weights is adapted on batches mixing the crops of all the examples of the group
+    (dataset_train yields batch_size / ttt_group_size crops per example), then every example of the group
+    is classified with the adapted weights before the reset. All the examples of a group get the same losses.
+    """
+    assert not args.print_images, 'print_images is not supported with ttt_group_size > 1.'
+    assert not args.stored_latents, 'stored_latents is not supported with ttt_group_size > 1.'
+    assert not args.early_stop, 'early_stop is not supported with ttt_group_size > 1.'
+    assert not args.host_sync_free, 'host_sync_free is not supported with ttt_group_size > 1.'
+    assert args.confidence_gate == 'none', 'confidence_gate is not supported with ttt_group_size > 1.'
+    assert args.step_budget == 0, 'step_budget is not supported with ttt_group_size > 1.'
+    assert args.warm_start_cache == 0, 'warm_start_cache is not supported with ttt_group_size > 1.'
+    assert args.frozen_dtype == 'fp32', 'frozen_dtype bf16 is not supported with ttt_group_size > 1.'
+    assert args.ttt_batch_examples == 1, 'ttt_batch_examples > 1 is not supported with ttt_group_size > 1.'
+    group_size = args.ttt_group_size
+    accum_iter = args.accum_iter
+    num_steps = args.steps_per_example * accum_iter
+    clone_model = _build_clone_model(args, num_classes)
+    if args.share_frozen:
+        clone_model = _share_frozen_modules(clone_model, base_model, args)
+
+    eval_steps = parse_eval_schedule(args.eval_schedule, args.steps_per_example)
+    eval_index = {step: i for i, step in enumerate(eval_steps)}
+    _save_eval_steps(args, eval_steps)
+    mask_ratios = _mask_ratio_schedule(clone_model, args, args.steps_per_example)
+    if args.mask_ratio_schedule != 'constant':
+        _log_mask_ratio_schedule(clone_model, mask_ratios, args)
+    all_results = [list() for i in range(len(eval_steps))]
+    all_losses = [list() for i in range(args.steps_per_example)]
+    all_steps = []
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    dataset_len = len(dataset_val) if iter_end is None else iter_end
+    num_examples = dataset_len - iter_start
+    # Examples are numbered from the start index of the datasets.
+    train_loader = iter(torch.utils.data.DataLoader(dataset_train, num_workers=args.num_workers,
+                                                    batch_sampler=_stack_batches(iter_start - dataset_train.start_index, num_examples,
+                                                                                 group_size, num_steps)))
+    val_loader = iter(torch.utils.data.DataLoader(dataset_val, num_workers=args.num_workers,
+                                                  batch_sampler=_stack_batches(iter_start - dataset_val.start_index, num_examples,
+                                                                               group_size, 1)))
+    journal = ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl'))
+    model, optimizer, loss_scaler = _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
+    snapshot = _snapshot_model(model, loss_scaler, args)
+    if log_writer is not None:
+        print('log_dir: {}'.format(log_writer.log_dir))
+
+    for group_start in range(iter_start, dataset_len, group_size):
+        group_start_time = _synchronized_time(device)
+        test_samples, test_label = next(val_loader)
+        test_samples = test_samples.to(device, non_blocking=True).flatten(0, 1)
+        test_label = test_label.to(device, non_blocking=True)
+        num_group_examples = len(test_label)
+        group_results = [list() for i in range(len(eval_steps))]
+        group_losses = [0.] * args.steps_per_example
+        for step_per_example in range(num_steps):
+            samples, _ = next(train_loader)
+            # The crops of all the examples of the group form one batch.
+            samples = samples.to(device, non_blocking=True).flatten(0, 1)
+            with _autocast(args.precision, device):
+                loss_dict, _, _, _, _ = model(samples, None, mask_ratio=mask_ratios[step_per_example // accum_iter])
             loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
             loss_value = loss.item()
-            loss /= accum_iter
             if not math.isfinite(loss_value):
                 print("Loss is {}, stopping training".format(loss_value))
                 sys.exit(1)
-            loss_scaler(loss, optimizer, parameters=model.parameters(),
+            loss_scaler(loss / accum_iter, optimizer, parameters=model.parameters(),
                         update_grad=(step_per_example + 1) % accum_iter == 0)
+            metric_logger.update(mae=loss_value)
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
             if (step_per_example + 1) % accum_iter == 0:
-                if args.verbose:
-                    print(f'datapoint {data_iter_step} iter {step_per_example}: rec_loss {loss_value}')
-
-                all_losses[step_per_example // accum_iter].append(loss_value/accum_iter)
                 optimizer.zero_grad()
-
-
-            metric_logger.update(**{k:v.item() for k,v in loss_dict.items()})
-            lr = optimizer.param_groups[0]["lr"]
-            metric_logger.update(lr=lr)
-            # Test:
-            if (step_per_example + 1) % accum_iter == 0:
+                group_losses[step_per_example // accum_iter] = loss_value / accum_iter
+            if (step_per_example + 1) % accum_iter == 0 and step_per_example // accum_iter in eval_index:
                 with torch.no_grad():
                     model.eval()
-                    all_pred = []
-                    for _ in range(accum_iter):
-                        loss_d, _, _, pred,_ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
-                        if args.verbose:
-                            cls_loss = loss_d['classification'].item()
-                            print(f'datapoint {data_iter_step} iter {step_per_example}: class_loss {cls_loss}')
-                        all_pred.extend(list(pred.argmax(axis=1).detach().cpu().numpy()))
-                    acc1 = (stats.mode(all_pred).mode[0] == test_label[0].cpu().detach().numpy()) * 100.
-                    if (step_per_example + 1) // accum_iter == args.steps_per_example:
-                        metric_logger.update(top1_acc=acc1)
-                        metric_logger.update(loss=loss_value)
-                    all_results[step_per_example // accum_iter].append(acc1)
+                    with _autocast(args.precision, device):
+                        _, _, _, pred, _ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
                     model.train()
+                    correct = (pred.argmax(axis=1) == test_label).cpu().numpy()
+                group_results[eval_index[step_per_example // accum_iter]] = list(correct * 100.)
+                if args.verbose:
+                    print(f'datapoints {group_start}-{group_start + num_group_examples - 1} iter {step_per_example}: rec_loss {loss_value}')
+        metric_logger.update(top1_acc=float(np.mean(group_results[-1])))
+        metric_logger.update(example_time=(_synchronized_time(device) - group_start_time) / num_group_examples)
+
+        for example in range(num_group_examples):
+            data_iter_step = group_start + example
+            for i in range(len(eval_steps)):
+                all_results[i].append(group_results[i][example])
+            for step in range(args.steps_per_example):
+                all_losses[step].append(group_losses[step])
+            all_steps.append(args.steps_per_example)
+            if data_iter_step % 50 == 1:
+                print('step: {}, acc {} rec-loss {}'.format(data_iter_step, np.mean(all_results[-1]), group_losses[-1]))
+            _record_example(journal, args, data_iter_step, dataset_len, all_results, all_losses, all_steps,
+                            steps=args.steps_per_example)
+        model, optimizer, loss_scaler = _reset_model(model, optimizer, loss_scaler, snapshot, base_model, base_optimizer,
+                                                     base_scalar, clone_model, args, device)
+
+    journal.close()
+    if 'example_time' in metric_logger.meters:
+        print('Groups of {}: {:.0f} images/hour, top1 acc {:.2f}'.format(
+            group_size, 3600 / metric_logger.example_time.global_avg, metric_logger.top1_acc.global_avg))
+    if args.group_reference_dir:
+        reference_accuracy = _read_final_accuracy(args.group_reference_dir)
+        if reference_accuracy is None:
+            print(f'No accuracy.txt of a per-example run in {args.group_reference_dir}')
+        else:
+            print('Top1 acc {:.2f} with groups of {} against {:.2f} per example ({})'.format(
+                metric_logger.top1_acc.global_avg, group_size, reference_accuracy, args.group_reference_dir))
+    if merge_results:
+        save_accuracy_results(args)
+    print("Averaged stats:", metric_logger)
+    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+
+
+def shard_examples(num_examples, shard, num_shards, args):
+    """Contiguous slice of the examples handled by a shard, resumed from the results files and journal of that slice."""
+    bounds = np.linspace(0, num_examples, num_shards + 1).astype(int)
+    iter_start, iter_end = int(bounds[shard]), int(bounds[shard + 1])
+    known_files = [int(i.split('results_')[-1].split('.npy')[0]) for i in glob.glob(os.path.join(args.output_dir, 'results_*.npy'))]
+    known_files.extend(ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl')).records())
+    known_files = [i for i in known_files if iter_start <= i < iter_end]
+    if len(known_files) > 0:
+        iter_start = max(known_files) + 1
+    return iter_start, iter_end
+
+
+def merge_sharded_results(args, shard, num_shards):
+    """Marks a shard as done. The last shard to finish merges the results of all the shards into accuracy.txt."""
+    with open(os.path.join(args.output_dir, f'shard_{shard}_of_{num_shards}.done'), 'w') as f:
+        f.write('Done!\n')
+    if not all(os.path.exists(os.path.join(args.output_dir, f'shard_{i}_of_{num_shards}.done')) for i in range(num_shards)):
+        return
+    try:
+        # Only one of the shards finishing at the same time does the merge.
+        os.close(os.open(os.path.join(args.output_dir, f'merge_{num_shards}.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+    save_accuracy_results(args)
 
-            if (args.print_images) and data_iter_step % 10 == 0 :
 
-                if (step_per_example in indices_to_show) :
+def _process_pool_worker(worker, base_model, base_optimizer, base_scalar, dataset_train, dataset_val, device, args, num_classes):
+    torch.set_num_threads(args.threads_per_process)
+    # Every worker resumes its own slice from its own results files.
+    iter_start, iter_end = shard_examples(len(dataset_val), worker, args.num_processes, args)
+    print(f'Worker {worker}: examples {iter_start} to {iter_end - 1}', force=True)
+    if iter_start < iter_end:
+        train_on_test(base_model, base_optimizer, base_scalar, dataset_train, dataset_val, device, args=args,
+                      num_classes=num_classes, iter_start=iter_start, iter_end=iter_end, merge_results=False)
+
+
+def train_on_test_process_pool(base_model: torch.nn.Module,
+                               base_optimizer,
+                               base_scalar,
+                               dataset_train, dataset_val,
+                               device: torch.device,
+                               log_writer=None,
+                               args=None,
+                               num_classes: int = 1000):
+    """Runs train_on_test in args.num_processes forked CPU workers, each on a contiguous slice of the dataset.
+
+    The base weights are moved to shared memory before forking, so they are loaded once and every worker
+    only allocates its own adapted copy. The datasets must start at index 0; the results of all the workers
+    are merged into accuracy.txt once they are done.
+    """
+    assert device.type == 'cpu', 'The process pool is meant for CPU test time training.'
+    assert dataset_val.start_index == 0 and dataset_train.start_index == 0
+    assert args.ttt_group_size == 1 and args.ttt_batch_examples == 1, \
+        'The workers run train_on_test: ttt_group_size and ttt_batch_examples are not supported with num_processes > 1.'
+    base_model.share_memory()
+    context = torch.multiprocessing.get_context('fork')
+    processes = [context.Process(target=_process_pool_worker,
+                                 args=(worker, base_model, base_optimizer, base_scalar, dataset_train, dataset_val, device, args, num_classes))
+                 for worker in range(args.num_processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [worker for worker, p in enumerate(processes) if p.exitcode != 0]
+    assert len(failed) == 0, f'Workers {failed} failed, rerun to resume them.'
+    save_accuracy_results(args)
 
-                    reconstructed_img = model.unpatchify(pred_patches[0].unsqueeze(0))
-                    mask1 = mask[0].clone()
-                    mask1[mask[0] == 1] = 0
-                    mask1[mask[0] == 0] = 1
-                    reconstructed_img = apply_mask_to_image(reconstructed_img.squeeze(0), mask1, patch_size=16)
 
-                    reconstructed_imgs.append(reconstructed_img)
-                    class_losses.append(cls_loss)
-                    rec_losses.append(loss_value)
-                    steps.append(step_per_example)
+def _online_state_path(args):
+    return os.path.join(args.output_dir, 'online_state.pth')
 
-                    if step_per_example == args.steps_per_example * accum_iter - 1 :
 
-                        original = samples[0].clone()
-                        patch_size = 16
-                        masked_image = apply_mask_to_image(original, mask[0], patch_size)
+def online_state_example(args):
+    """Last example of the online state saved in args.output_dir, or -1. An online run resumes right after it."""
+    if not os.path.exists(_online_state_path(args)):
+        return -1
+    return torch.load(_online_state_path(args), map_location='cpu')['example']
 
-                        original = samples[0].squeeze().detach().cpu()
-                        masked_image = masked_image.squeeze().detach().cpu()
-                        reconstructed_img = reconstructed_img.squeeze().detach().cpu()
 
-                        save_dir = '/home/toniomirri/Images_evolution'
-                        file_name = f'image_{data_iter_step}.png'
+def _save_online_state(args, example, model, optimizer, loss_scaler, rollback_ring=None, shift_detector=None):
+    """Saves the state an online run resumes from after example: the adapted weights, the optimizer and loss scaler
+    states, the captures of the rollback ring and the window of the shift detector."""
+    shared_keys = getattr(model, 'shared_keys', ())
+    state = {'example': example, 'model': {k: v for k, v in model.state_dict().items() if not k.startswith(shared_keys)},
+             'optimizer': optimizer.state_dict(), 'loss_scaler': loss_scaler.state_dict(),
+             'rollback': rollback_ring.captures() if rollback_ring is not None else None,
+             'shift_detector': (list(shift_detector.losses), list(shift_detector.features)) if shift_detector is not None else None}
+    tmp_path = _online_state_path(args) + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, _online_state_path(args))
 
-                        display_images(original,masked_image,reconstructed_imgs,save_dir,file_name,rec_losses,class_losses,steps)
 
-        if data_iter_step % 50 == 1:
-            print('step: {}, acc {} rec-loss {}'.format(data_iter_step, np.mean(all_results[-1]), loss_value))
-        if data_iter_step % 500 == 499 or (data_iter_step == dataset_len - 1):
-            with open(os.path.join(args.output_dir, f'results_{data_iter_step}.npy'), 'wb') as f:
-                np.save(f, np.array(all_results))
-            with open(os.path.join(args.output_dir, f'losses_{data_iter_step}.npy'), 'wb') as f:
-                np.save(f, np.array(all_losses))
-            all_results = [list() for i in range(args.steps_per_example)]
-            all_losses = [list() for i in range(args.steps_per_example)]
-        model, optimizer, loss_scaler = _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
+def _online_result_index(burst, step_per_example, num_steps_per_example, args):
+    """Row of the results of an online step: the warm-up burst of the first example, or of the example after
+    a detected shift, only records its last steps_per_example steps."""
+    if not burst :
+        return step_per_example // args.accum_iter
+    elif num_steps_per_example - step_per_example <= args.steps_per_example :
+        return (args.steps_per_example - (num_steps_per_example - step_per_example)) // args.accum_iter
+    return None
 
-    save_accuracy_results(args)
-    # gather the stats from all processes
-    try:
-        print("Averaged stats:", metric_logger)
-        return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
-    except:
-        pass
-    return
+
+# The arguments the state reached by the online warm-up burst depends on, besides the checkpoints and the image.
+_BURST_KEY_ARGS = ('model', 'input_size', 'adapt_input_size', 'head_type', 'classifier_depth', 'finetune_mode', 'finetune_blocks',
+                   'batch_size', 'accum_iter', 'lr', 'optimizer_type', 'optimizer_momentum', 'weight_decay', 'load_loss_scalar',
+                   'mask_ratio', 'mask_ratio_schedule', 'norm_pix_loss', 'single_crop', 'precision', 'frozen_dtype', 'host_sync_free',
+                   'steps_per_example', 'share_frozen')
+
+
+def _burst_key_parts(args):
+    parts = {name: getattr(args, name) for name in _BURST_KEY_ARGS}
+    parts['checkpoints'] = [misc.file_checksum(path) for path in (args.resume_model, args.resume_finetune)]
+    parts['data_path'] = os.path.abspath(args.data_path)
+    return parts
+
+
+def _shift_signals(model, train_loader, mask_ratio, args, device):
+    """Runs the forward of the first training step of an example, before the shift detector decides whether to reset the model.
+    Returns the crops and the outputs of the forward, which the adaptation reuses, and the shift signals:
+    the MAE loss and the mean encoder cls feature."""
+    train_data = next(train_loader)
+    samples = train_data[0].to(device, non_blocking=True)[0]
+    with _autocast(args.precision, device):
+        outputs = model(samples, None, mask_ratio=mask_ratio)
+    return (train_data, samples, outputs), outputs[0]['mae'].item(), outputs[2].detach().float().mean(axis=0).cpu().numpy()
+
+
+def _online_mask_ratios(mask_ratio_schedules, clone_model, num_steps_per_example, args):
+    """Mask ratio schedule of an online example, cached by number of optimizer steps in mask_ratio_schedules."""
+    num_optimizer_steps = -(-num_steps_per_example // args.accum_iter)
+    if num_optimizer_steps not in mask_ratio_schedules:
+        mask_ratio_schedules[num_optimizer_steps] = _mask_ratio_schedule(clone_model, args, num_optimizer_steps)
+    return mask_ratio_schedules[num_optimizer_steps]
 
 
 def train_on_test_online(base_model: torch.nn.Module,
@@ -254,44 +1308,84 @@ def train_on_test_online(base_model: torch.nn.Module,
                   args=None,
                   num_classes: int = 1000,
                   iter_start: int = 0):
-    if args.model == 'mae_vit_small_patch16':
-        classifier_depth = 8
-        classifier_embed_dim = 512
-        classifier_num_heads = 16
-    else:
-        assert ('mae_vit_huge_patch14' in args.model or args.model == 'mae_vit_large_patch16')
-        classifier_embed_dim = 768
-        classifier_depth = 12
-        classifier_num_heads = 12
-    clone_model = models_mae_shared.__dict__[args.model](num_classes=num_classes, head_type=args.head_type,
-                                                         norm_pix_loss=args.norm_pix_loss,
-                                                         classifier_depth=classifier_depth, classifier_embed_dim=classifier_embed_dim,
-                                                         classifier_num_heads=classifier_num_heads,
-                                                         rotation_prediction=False)
+    clone_model = _build_clone_model(args, num_classes)
+    assert args.frozen_dtype == 'fp32' or (args.share_frozen and not args.stored_latents), \
+        'frozen_dtype bf16 casts the modules shared with share_frozen, it needs share_frozen and no stored_latents.'
+    if args.share_frozen and not args.stored_latents:
+        clone_model = _share_frozen_modules(clone_model, base_model, args)
+        if args.frozen_dtype == 'bf16':
+            _cast_frozen_modules(clone_model, torch.bfloat16)
 
     # Intialize the model for the current run
     all_results = [list() for i in range(args.steps_per_example)]
     all_losses =  [list() for i in range(args.steps_per_example)]
     metric_logger = misc.MetricLogger(delimiter="  ")
-    train_loader = iter(torch.utils.data.DataLoader(dataset_train, batch_size=1, shuffle=False, num_workers=args.num_workers))
+    if args.shift_detector:
+        assert not args.shuffle and not args.reinitialize_first_last_one, \
+            'The shift detector needs the ordered stream and the model it resets not to be rolled back.'
+        # The number of steps of an example is only known once its signals are measured: every example has
+        # room for a warm-up burst in dataset_train and its crops are loaded one example at a time.
+        shift_detector = ShiftDetector(args.shift_threshold, args.shift_window, args.shift_min_examples)
+        shift_triggers = []
+        example_sampler = _ExampleSampler(dataset_train.steps_per_example)
+        train_crops = torch.utils.data.DataLoader(dataset_train, batch_size=1, sampler=example_sampler, num_workers=args.num_workers,
+                                                  persistent_workers=args.num_workers > 0)
+    else:
+        train_loader = iter(torch.utils.data.DataLoader(dataset_train, batch_size=1, shuffle=False, num_workers=args.num_workers))
     val_loader = iter(torch.utils.data.DataLoader(dataset_val, batch_size=1, shuffle=False, num_workers=args.num_workers))
     accum_iter = args.accum_iter
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
 
     num_steps_per_example = args.steps_per_example * accum_iter
+    _save_eval_steps(args, list(range(args.steps_per_example)))
+    # Schedules by number of optimizer steps, as the warm-up bursts are longer than the other examples.
+    mask_ratio_schedules = {args.steps_per_example: _mask_ratio_schedule(clone_model, args, args.steps_per_example)}
+    if args.mask_ratio_schedule != 'constant':
+        _log_mask_ratio_schedule(clone_model, mask_ratio_schedules[args.steps_per_example], args)
+    burst_cache = BurstCache(args.burst_cache) if args.burst_cache else None
+    if burst_cache is not None:
+        burst_key_parts = _burst_key_parts(args)
+        shared_keys = getattr(clone_model, 'shared_keys', ())
+    journal = ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl'))
 
 
     model, optimizer, loss_scaler = _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
+    snapshot = _snapshot_model(model, loss_scaler, args)
+    if args.host_sync_free:
+        assert not (args.print_images or args.verbose), 'print_images and verbose need the losses on the host at every step.'
+        sync_free_buffers = _sync_free_buffers(max(args.steps_first_example, args.steps_per_example * accum_iter), device)
+    if args.reinitialize_first_last_one :
+        # Weights and optimizer state after the first step of the last rollback_depth examples.
+        # Only the trainable parameters are copied: the ones of the in-place snapshot, or gathered for the ring.
+        ring_parameters = snapshot[0] if snapshot is not None else \
+            ParameterSnapshot((p for p in model.parameters() if p.requires_grad), keep_pristine=False)
+        rollback_ring = SnapshotRing(ring_parameters, args.rollback_depth)
+    online_state = None
+    if iter_start > 0:
+        # The stream goes on from the state saved with the last results files, without a new warm-up burst.
+        online_state = torch.load(_online_state_path(args), map_location=device)
+        assert online_state['example'] == iter_start - 1, 'The online state does not match the resumed example.'
+        print(f"Resuming the online model and optimizer states after example {online_state['example']}")
+        _load_unshared_state_dict(model, online_state['model'])
+        optimizer.load_state_dict(online_state['optimizer'])
+        loss_scaler.load_state_dict(online_state['loss_scaler'])
+        if args.shift_detector:
+            shift_detector.losses.extend(online_state['shift_detector'][0])
+            shift_detector.features.extend(online_state['shift_detector'][1])
     if args.reinitialize_first_last_one :
-        # state_dict_model_previous = model.state_dict()
-        # state_dict_optimizer_previous = optimizer.state_dict()
-        torch.save({'model' : model.state_dict()},'/home/toniomirri/checkpoints/last_online_weights.pth')
+        if online_state is None:
+            rollback_ring.capture(optimizer)
+        else:
+            for flat, optimizer_state in online_state['rollback']:
+                rollback_ring.push(flat, optimizer_state)
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
     dataset_len = len(dataset_val)
 
     if args.print_images :
+        image_writer = AsyncImageWriter(args.print_images_dir or os.path.join(args.output_dir, 'images_evolution'),
+                                        model.patch_embed.patch_size[0], args.print_images_queue)
         s = (args.steps_per_example * accum_iter - 1) / (args.num_print_images - 1)
         indices_to_show = {int(round(i * s)) for i in range(args.num_print_images - 1)}
         indices_to_show.add(args.steps_per_example * accum_iter - 1)
@@ -306,132 +1400,199 @@ def train_on_test_online(base_model: torch.nn.Module,
         val_data = next(val_loader)
         (test_samples, test_label) = val_data
         test_samples = test_samples.to(device, non_blocking=True)[0]
+        test_label_value = int(test_label[0])
         test_label = test_label.to(device, non_blocking=True)
         pseudo_labels = None
 
+        burst = data_iter_step == iter_start and online_state is None
         if args.online_ttt :
-            if data_iter_step == iter_start :
+            if burst :
                 num_steps_per_example = args.steps_first_example
             else :
                 num_steps_per_example = args.steps_per_example
 
-        #Reinitialize the model to the first step of the last example
+        #Reinitialize the model to the first step of the rollback_depth-th last example
         if args.reinitialize_first_last_one :
-            #model = clone_model
-            model_checkpoint = torch.load('/home/toniomirri/checkpoints/last_online_weights.pth', map_location='cpu')
-            model.load_state_dict(model_checkpoint['model'])
-            # model.load_state_dict(copy.deepcopy(state_dict_model_previous))
-            # if args.optimizer_type == 'sgd':
-            #     optimizer = torch.optim.SGD(get_prameters_from_args(clone_model, args), lr=args.lr, momentum=args.optimizer_momentum)
-            # elif args.optimizer_type == 'adam':
-            #     optimizer = torch.optim.Adam(get_prameters_from_args(clone_model, args), lr=args.lr, betas=(0.9, 0.95))
-            # else:
-            #     assert args.optimizer_type == 'adam_w'
-            #     optimizer = torch.optim.AdamW(get_prameters_from_args(clone_model, args), lr=args.lr, betas=(0.9, 0.95))
-            # optimizer.load_state_dict(state_dict_optimizer_previous)
+            rollback_ring.restore(optimizer, age=args.rollback_depth - 1)
             optimizer.zero_grad()
+        mask_ratios = _online_mask_ratios(mask_ratio_schedules, clone_model, num_steps_per_example, args)
+        first_forward = None
+        if args.shift_detector:
+            example_sampler.example = data_iter_step - dataset_train.start_index
+            train_loader = iter(train_crops)
+            # The signals come from the forward of the first training step, which the adaptation then reuses.
+            first_forward, shift_loss, shift_feature = _shift_signals(model, train_loader, mask_ratios[0], args, device)
+            if shift_detector.step(shift_loss, shift_feature) and not burst:
+                print(f"Distribution shift detected at example {data_iter_step}, reinitializing the model...")
+                shift_triggers.append(data_iter_step)
+                burst = True
+                num_steps_per_example = args.steps_first_example
+                mask_ratios = _online_mask_ratios(mask_ratio_schedules, clone_model, num_steps_per_example, args)
+                # Only on a shift, the first step runs again, on the reset model.
+                train_loader = itertools.chain([first_forward[0]], train_loader)
+                first_forward = None
+                model, optimizer, loss_scaler = _reset_model(model, optimizer, loss_scaler, snapshot, base_model, base_optimizer,
+                                                             base_scalar, clone_model, args, device)
+            metric_logger.update(shifts=len(shift_triggers))
+        example_start = _synchronized_time(device)
+        cached_burst = None
+        if burst and burst_cache is not None:
+            # The image the burst adapts on is identified by its content.
+            burst_parts = dict(burst_key_parts, steps=num_steps_per_example,
+                               image=hashlib.sha256(test_samples.cpu().numpy().tobytes()).hexdigest())
+            burst_key = burst_cache.key(burst_parts)
+            cached_burst = burst_cache.load(burst_key, map_location=device)
+            if cached_burst is not None and args.reinitialize_first_last_one and cached_burst.get('rollback') is None:
+                # Entry saved without the state the rollback ring needs: the burst is computed again.
+                cached_burst = None
+            metric_logger.update(burst_cache_hit=int(cached_burst is not None))
 
         # Test time training:
 
-        for step_per_example in range(num_steps_per_example):
-            train_data = next(train_loader)
-            # Train data are 2 values [image, class]
-            mask_ratio = args.mask_ratio
-            samples, _ = train_data
-            targets_rot, samples_rot = None, None
-            samples = samples.to(device, non_blocking=True)[0] # index [0] becuase the data is batched to have size 1.
-            loss_dict, pred_patches, _, _, mask = model(samples, None, mask_ratio=mask_ratio)
-            loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
-            loss_value = loss.item()
-            loss /= accum_iter
-            if not math.isfinite(loss_value):
-                print("Loss is {}, stopping training".format(loss_value))
-                sys.exit(1)
-            loss_scaler(loss, optimizer, parameters=model.parameters(),
-                        update_grad=(step_per_example + 1) % accum_iter == 0)
-            if (step_per_example + 1) % accum_iter == 0:
-                if args.verbose:
-                    print(f'datapoint {data_iter_step} iter {step_per_example}: rec_loss {loss_value}')
-                if data_iter_step == iter_start and num_steps_per_example - step_per_example <= args.steps_per_example :
-                    all_losses[(args.steps_per_example - (num_steps_per_example - step_per_example)) // accum_iter].append(loss_value/accum_iter)
-                elif data_iter_step > 0 :
-                    all_losses[step_per_example // accum_iter].append(loss_value/accum_iter)
-                optimizer.zero_grad()
-
-
-            metric_logger.update(**{k:v.item() for k,v in loss_dict.items()})
-            lr = optimizer.param_groups[0]["lr"]
-            metric_logger.update(lr=lr)
-            # Test:
-            if (step_per_example + 1) % accum_iter == 0:
-                with torch.no_grad():
-                    model.eval()
-                    all_pred = []
-                    for _ in range(accum_iter):
-                        loss_d, _, _, pred,_ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
-                        if args.verbose:
-                            cls_loss = loss_d['classification'].item()
-                            print(f'datapoint {data_iter_step} iter {step_per_example}: class_loss {cls_loss}')
-                        all_pred.extend(list(pred.argmax(axis=1).detach().cpu().numpy()))
-                    acc1 = (stats.mode(all_pred).mode[0] == test_label[0].cpu().detach().numpy()) * 100.
-                    if (step_per_example + 1) // accum_iter == num_steps_per_example:
-                        metric_logger.update(top1_acc=acc1)
-                        metric_logger.update(loss=loss_value)
-                    if data_iter_step == iter_start and num_steps_per_example - step_per_example <= args.steps_per_example :
-                        all_results[(args.steps_per_example - (num_steps_per_example - step_per_example)) // accum_iter].append(acc1)
-                    elif data_iter_step > 0 :
-                        all_results[step_per_example // accum_iter].append(acc1)
-                    model.train()
-
-            if args.reinitialize_first_last_one and step_per_example == 0 :
-                torch.save({'model' : model.state_dict()},'/home/toniomirri/checkpoints/last_online_weights.pth')
-                # state_dict_model_previous = model.state_dict()
-                # state_dict_optimizer_previous = optimizer.state_dict()
-
-            if (args.print_images) and data_iter_step % 10 == 0 :
-
-                if (step_per_example in indices_to_show) :
-
-                    reconstructed_img = model.unpatchify(pred_patches[0].unsqueeze(0))
-                    mask1 = mask[0].clone()
-                    mask1[mask[0] == 1] = 0
-                    mask1[mask[0] == 0] = 1
-                    reconstructed_img = apply_mask_to_image(reconstructed_img.squeeze(0), mask1, patch_size=16)
-
-                    reconstructed_imgs.append(reconstructed_img)
-                    class_losses.append(cls_loss)
-                    rec_losses.append(loss_value)
-                    steps.append(step_per_example)
-
-                    if step_per_example == args.steps_per_example * accum_iter - 1 :
-
-                        original = samples[0].clone()
-                        patch_size = 16
-                        masked_image = apply_mask_to_image(original, mask[0], patch_size)
-
-                        original = samples[0].squeeze().detach().cpu()
-                        masked_image = masked_image.squeeze().detach().cpu()
-                        reconstructed_img = reconstructed_img.squeeze().detach().cpu()
-
-                        save_dir = '/home/toniomirri/Images_evolution'
-                        file_name = f'image_{data_iter_step}.png'
-
-                        display_images(original,masked_image,reconstructed_imgs,save_dir,file_name,rec_losses,class_losses,steps)
-
+        if cached_burst is not None:
+            print(f"Warm-up burst of example {data_iter_step} restored from {args.burst_cache}")
+            if args.reinitialize_first_last_one:
+                # The ring keeps the state after the first step of the burst, saved with the entry.
+                rollback_ring.push(*cached_burst['rollback'])
+            _load_unshared_state_dict(model, cached_burst['model'])
+            optimizer.load_state_dict(cached_burst['optimizer'])
+            optimizer.zero_grad()
+            loss_scaler.load_state_dict(cached_burst['loss_scaler'])
+            for index in range(args.steps_per_example):
+                all_losses[index].append(cached_burst['losses'][index])
+                all_results[index].append(cached_burst['results'][index])
+            loss_value = cached_burst['loss_value']
+            metric_logger.update(top1_acc=cached_burst['results'][-1])
+            metric_logger.update(loss=loss_value)
+            if not args.shift_detector:
+                # Skip the crops of the burst without loading them.
+                train_loader = iter(torch.utils.data.DataLoader(dataset_train, batch_size=1, num_workers=args.num_workers,
+                                                                sampler=range(num_steps_per_example, len(dataset_train))))
+        elif args.host_sync_free:
+            def after_step(step_per_example):
+                if args.reinitialize_first_last_one and step_per_example == 0 :
+                    rollback_ring.capture(optimizer)
+            num_steps = num_steps_per_example // accum_iter
+            step_losses, step_preds = _adapt_example_sync_free(model, optimizer, train_loader, test_samples, test_label,
+                                                               num_steps_per_example, list(range(num_steps)), args, device,
+                                                               sync_free_buffers, metric_logger, after_step=after_step, mask_ratios=mask_ratios,
+                                                               first_forward=first_forward)
+            for step in range(num_steps):
+                index = _online_result_index(burst, (step + 1) * accum_iter - 1, num_steps_per_example, args)
+                if index is not None:
+                    all_losses[index].append(step_losses[step] / accum_iter)
+                    all_results[index].append((step_preds[step] == test_label_value) * 100.)
+            loss_value = float(step_losses[-1])
+            metric_logger.update(mae=float(np.mean(step_losses)))
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+            metric_logger.update(top1_acc=(step_preds[-1] == test_label_value) * 100.)
+            metric_logger.update(loss=loss_value)
+        else:
+            for step_per_example in range(num_steps_per_example):
+                if step_per_example == 0 and first_forward is not None:
+                    _, samples, (loss_dict, pred_patches, _, _, mask) = first_forward
+                    first_forward = None
+                else:
+                    train_data = next(train_loader)
+                    # Train data are 2 values [image, class]
+                    mask_ratio = mask_ratios[step_per_example // accum_iter]
+                    samples, _ = train_data
+                    targets_rot, samples_rot = None, None
+                    samples = samples.to(device, non_blocking=True)[0] # index [0] becuase the data is batched to have size 1.
+                    with _autocast(args.precision, device):
+                        loss_dict, pred_patches, _, _, mask = model(samples, None, mask_ratio=mask_ratio)
+                loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
+                loss_value = loss.item()
+                loss /= accum_iter
+                if not math.isfinite(loss_value):
+                    print("Loss is {}, stopping training".format(loss_value))
+                    sys.exit(1)
+                loss_scaler(loss, optimizer, parameters=model.parameters(),
+                            update_grad=(step_per_example + 1) % accum_iter == 0)
+                if (step_per_example + 1) % accum_iter == 0:
+                    if args.verbose:
+                        print(f'datapoint {data_iter_step} iter {step_per_example}: rec_loss {loss_value}')
+                    index = _online_result_index(burst, step_per_example, num_steps_per_example, args)
+                    if index is not None:
+                        all_losses[index].append(loss_value/accum_iter)
+                    optimizer.zero_grad()
+
+
+                metric_logger.update(**{k:v.item() for k,v in loss_dict.items()})
+                lr = optimizer.param_groups[0]["lr"]
+                metric_logger.update(lr=lr)
+                # Test:
+                if (step_per_example + 1) % accum_iter == 0:
+                    with torch.no_grad():
+                        model.eval()
+                        all_pred = []
+                        for _ in range(accum_iter):
+                            with _autocast(args.precision, device):
+                                loss_d, _, _, pred,_ = model(test_samples, test_label, mask_ratio=0, reconstruct=False)
+                            if args.verbose:
+                                cls_loss = loss_d['classification'].item()
+                                print(f'datapoint {data_iter_step} iter {step_per_example}: class_loss {cls_loss}')
+                            all_pred.extend(list(pred.argmax(axis=1).detach().cpu().numpy()))
+                        acc1 = (stats.mode(all_pred).mode[0] == test_label[0].cpu().detach().numpy()) * 100.
+                        if (step_per_example + 1) // accum_iter == num_steps_per_example:
+                            metric_logger.update(top1_acc=acc1)
+                            metric_logger.update(loss=loss_value)
+                        index = _online_result_index(burst, step_per_example, num_steps_per_example, args)
+                        if index is not None:
+                            all_results[index].append(acc1)
+                        model.train()
+
+                if args.reinitialize_first_last_one and step_per_example == 0 :
+                    rollback_ring.capture(optimizer)
+
+                if (args.print_images) and data_iter_step % 10 == 0 :
+
+                    if (step_per_example in indices_to_show) :
+
+                        # The masking and the rendering are done by the writer process.
+                        reconstructed_img = model.unpatchify(pred_patches[0].unsqueeze(0))[0]
+                        reconstructed_imgs.append((reconstructed_img.detach().cpu(), mask[0].detach().cpu()))
+                        class_losses.append(float(cls_loss))
+                        rec_losses.append(loss_value)
+                        steps.append(step_per_example)
+
+                        if step_per_example == args.steps_per_example * accum_iter - 1 :
+                            image_writer.submit(f'image_{data_iter_step}.png', samples[0].detach().cpu(), mask[0].detach().cpu(),
+                                                reconstructed_imgs, rec_losses, class_losses, steps)
+
+        if burst and burst_cache is not None and cached_burst is None:
+            burst_cache.save(burst_key, {
+                'model': {k: v for k, v in model.state_dict().items() if not k.startswith(shared_keys)},
+                'optimizer': optimizer.state_dict(), 'loss_scaler': loss_scaler.state_dict(),
+                'results': [r[-1] for r in all_results], 'losses': [l[-1] for l in all_losses], 'loss_value': loss_value,
+                # The burst is the last example captured by the rollback ring.
+                'rollback': rollback_ring.latest() if args.reinitialize_first_last_one else None,
+            }, parts=burst_parts)
+        example_time = _synchronized_time(device) - example_start
         if data_iter_step % 50 == 1:
             print('step: {}, acc {} rec-loss {}'.format(data_iter_step, np.mean(all_results[-1]), loss_value))
-        if data_iter_step % 500 == 499 or (data_iter_step == dataset_len - 1):
-            with open(os.path.join(args.output_dir, f'results_{data_iter_step}.npy'), 'wb') as f:
-                np.save(f, np.array(all_results))
-            with open(os.path.join(args.output_dir, f'losses_{data_iter_step}.npy'), 'wb') as f:
-                np.save(f, np.array(all_losses))
-            all_results = [list() for i in range(args.steps_per_example)]
-            all_losses = [list() for i in range(args.steps_per_example)]
+        _record_example(journal, args, data_iter_step, dataset_len, all_results, all_losses, example_time=example_time)
 
         if data_iter_step % (args.number_of_example_reinitialize - 1) == 0 and args.number_of_example_reinitialize > 0 :
             print(f"Reinitializing model after {args.number_of_example_reinitialize} examples...")
-            model, optimizer, loss_scaler = _reinitialize_model(base_model, base_optimizer, base_scalar, clone_model, args, device)
-
+            reset_start = _synchronized_time(device)
+            model, optimizer, loss_scaler = _reset_model(model, optimizer, loss_scaler, snapshot, base_model, base_optimizer,
+                                                         base_scalar, clone_model, args, device)
+            metric_logger.update(reset_time=_synchronized_time(device) - reset_start)
+        if data_iter_step % 500 == 499 or (data_iter_step == dataset_len - 1):
+            # Saved with the results files, which cover every example up to this one.
+            _save_online_state(args, data_iter_step, model, optimizer, loss_scaler, rollback_ring if args.reinitialize_first_last_one else None,
+                               shift_detector if args.shift_detector else None)
+
+    if 'reset_time' in metric_logger.meters:
+        print('Mean reset time per example ({}): {:.2f} ms'.format(args.reset_mode, 1000 * metric_logger.reset_time.global_avg))
+    journal.close()
+    if args.print_images:
+        image_writer.close()
+    if args.shift_detector:
+        print(f'Shift detector: {len(shift_triggers)} triggers over {dataset_len - iter_start} examples at {shift_triggers}')
+        with open(os.path.join(args.output_dir, f'shift_triggers_{iter_start}.npy'), 'wb') as f:
+            np.save(f, np.array(shift_triggers, dtype=np.int64))
     save_accuracy_results(args)
 
     if args.save_mae_online : 
@@ -446,29 +1607,183 @@ def train_on_test_online(base_model: torch.nn.Module,
     return
 
 
+class OnlineAdapter:
+    """Online test-time training on a stream of images, one predict() call per image.
+
+    Mirrors train_on_test_online without the datasets: the model keeps adapting from one image to the next,
+    with steps_first_example steps on the first image and steps_per_example steps on the next ones.
+    A wall-clock budget per image stops the adaptation early, before a step that would exceed it.
+    The latencies of the last latency_window images give the p50 and p99 of latency_stats().
+    The adapter adapts the caller's model in place: its trainable parameters are re-pointed into the flat buffer
+    of a ParameterSnapshot, which reset() restores.
+    """
+    def __init__(self, model, args, device, transform_train, transform_val, budget=None, latency_window=1000):
+        """model: a MaskedAutoencoderViT with its classification head, args: the test-time training arguments."""
+        self.args = args
+        self.device = device
+        self.transform_train = transform_train
+        self.transform_val = transform_val
+        self.budget = budget
+        self.model = model.to(device)
+        self.model.train(True)
+        lr = getattr(args, 'lr', None)
+        if lr is None:
+            # Same learning rate as main_test_time_training, without changing the caller's arguments.
+            lr = args.blr * args.batch_size * args.accum_iter / 256
+        self.optimizer = _build_optimizer(get_prameters_from_args(self.model, args), args, lr=lr)
+        self.loss_scaler = NativeScaler(enabled=_scaler_enabled(args, device))
+        self.snapshot = ParameterSnapshot(p for p in self.model.parameters() if p.requires_grad)
+        self.mask_ratios = {}
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.steps = collections.deque(maxlen=latency_window)
+        self.num_images = 0
+
+    def _crops(self, image):
+        if self.args.single_crop:
+            return self.transform_train(image).unsqueeze(0).repeat(self.args.batch_size, 1, 1, 1)
+        return torch.stack([self.transform_train(image) for _ in range(self.args.batch_size)], axis=0)
+
+    def predict(self, image, budget=None):
+        """Adapts the model on a PIL image, then returns its logits [1, num_classes]. budget overrides the default one."""
+        start = _synchronized_time(self.device)
+        budget = self.budget if budget is None else budget
+        accum_iter = self.args.accum_iter
+        num_steps = self.args.steps_first_example if self.num_images == 0 else self.args.steps_per_example
+        if num_steps not in self.mask_ratios:
+            self.mask_ratios[num_steps] = _mask_ratio_schedule(self.model, self.args, num_steps)
+        step_time = 0.
+        step = 0
+        for step in range(num_steps * accum_iter):
+            step_start = _synchronized_time(self.device)
+            # Only whole optimizer steps are stopped, before the one that would not fit in the budget.
+            if budget is not None and step % accum_iter == 0 and step_start + accum_iter * step_time - start > budget:
+                break
+            samples = self._crops(image).to(self.device, non_blocking=True)
+            with _autocast(self.args.precision, self.device):
+                loss_dict, _, _, _, _ = self.model(samples, None, mask_ratio=self.mask_ratios[num_steps][step // accum_iter])
+            loss = torch.stack([loss_dict[l] for l in loss_dict]).sum()
+            loss_value = loss.item()
+            if not math.isfinite(loss_value):
+                # The process embedding the adapter keeps running: the stream starts again from the initial weights.
+                self.optimizer.zero_grad()
+                self.reset()
+                raise FloatingPointError(f'Loss is {loss_value}, the adapter was reset to its initial weights.')
+            self.loss_scaler(loss / accum_iter, self.optimizer, parameters=self.model.parameters(),
+                             update_grad=(step + 1) % accum_iter == 0)
+            if (step + 1) % accum_iter == 0:
+                self.optimizer.zero_grad()
+            step_time = _synchronized_time(self.device) - step_start
+        else:
+            step = num_steps * accum_iter
+        self.optimizer.zero_grad()
+        with torch.no_grad():
+            self.model.eval()
+            test_samples = self.transform_val(image).unsqueeze(0).to(self.device, non_blocking=True)
+            with _autocast(self.args.precision, self.device):
+                latent, _, _ = self.model.forward_encoder(test_samples, mask_ratio=0)
+                if self.model.head_type == 'linear':
+                    pred, _ = self.model.forward_head(latent[:, 0], None)
+                else:
+                    pred, _ = self.model.forward_vit_head(latent, None)
+            self.model.train()
+        logits = pred.float()
+        self.num_images += 1
+        self.steps.append(step // accum_iter)
+        self.latencies.append(_synchronized_time(self.device) - start)
+        return logits
+
+    def reset(self):
+        """Goes back to the weights the adapter was built with, as for a new stream."""
+        self.snapshot.restore()
+        zero_optimizer_state_(self.optimizer)
+        self.num_images = 0
+
+    def latency_stats(self):
+        """Latency percentiles (seconds) and mean number of steps over the last latency_window images."""
+        if len(self.latencies) == 0:
+            return {}
+        latencies = np.array(self.latencies)
+        return {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                'mean': float(latencies.mean()), 'steps': float(np.mean(self.steps)), 'count': len(latencies)}
+
+
+@torch.no_grad()
+def evaluate_stored_latents(model, dataset_val, device, args):
+    """Classifies the test images from their stored encoder outputs (see util.latent_store).
+
+    Only the images missing from the store are encoded. The store is keyed by the encoder checkpoint,
+    so evaluating another classification head only reads the latents back from disk.
+    """
+    key = '{}_{}'.format(misc.file_checksum(args.resume_model)[:16], args.input_size)
+    store = LatentStore(args.stored_latents, key)
+    model.to(device)
+    model.eval()
+    paths = [path for path, _ in dataset_val.samples]
+    targets = [target for _, target in dataset_val.samples]
+    missing = [i for i, path in enumerate(paths) if path not in store]
+    if len(missing) > 0:
+        print(f'Encoding {len(missing)} images missing from {store.dir}')
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset_val, missing), batch_size=args.latent_batch_size,
+                                             shuffle=False, num_workers=args.num_workers)
+
+        def encode():
+            for samples, _ in loader:
+                samples = samples.to(device, non_blocking=True).flatten(0, 1)  # every item is a batch of size 1.
+                latent, _, _ = model.forward_encoder(samples, mask_ratio=0)
+                yield latent.float().cpu().numpy()
+        store.add_shard([paths[i] for i in missing], encode(), dtype=args.latent_dtype)
+
+    all_acc = []
+    all_losses = []
+    for start in range(0, len(paths), args.latent_batch_size):
+        latent = torch.from_numpy(store.get(paths[start:start + args.latent_batch_size])).to(device, non_blocking=True).float()
+        labels = torch.tensor(targets[start:start + args.latent_batch_size], device=device)
+        if model.head_type == 'linear':
+            head, _ = model.forward_head(latent[:, 0], labels)
+        else:
+            head, _ = model.forward_vit_head(latent, labels)
+        all_acc.extend((head.argmax(axis=1) == labels).cpu().numpy() * 100.)
+        all_losses.extend(torch.nn.functional.cross_entropy(head, labels, reduction='none').cpu().numpy())
+    print(f'Accuracy from stored latents: {np.mean(all_acc)}')
+    with open(os.path.join(args.output_dir, 'accuracy.txt'), 'a') as f:
+        f.write(f'{str(args)}\n')
+        f.write(f'{np.mean(all_acc)} {np.mean(all_losses)}\n')
+    with open(os.path.join(args.output_dir, 'accuracy.npy'), 'wb') as f:
+        np.save(f, np.array(all_acc))
 
 
 def save_accuracy_results(args):
-    # Initialisation des résultats pour chaque étape
-    all_all_results = [list() for i in range(args.steps_per_example)]
+    # Initialisation des résultats pour chaque étape évaluée
+    eval_steps = _load_eval_steps(args)
+    all_all_results = [list() for i in range(len(eval_steps))]
 
     # Calcul dynamique du nombre d'images
     # On récupère les fichiers .npy présents dans le dossier des résultats
     result_files = glob.glob(os.path.join(args.output_dir, 'results_*.npy'))
-    if len(result_files) > 0:
-        # Charger un des fichiers pour déterminer le nombre d'images
-        sample_data = np.load(result_files[0])
-        num_images = len(sample_data[0]) * len(result_files)
+    # Le fichier results_{idx}.npy contient les exemples contigus qui se terminent à idx.
+    covered = set()
+    for f_name in result_files:
+        last = int(f_name.split('results_')[-1].split('.npy')[0])
+        covered.update(range(last - len(np.load(f_name)[0]) + 1, last + 1))
+    # Les exemples terminés après le dernier fichier .npy ne sont que dans le journal.
+    journaled = ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl')).records()
+    journaled = [journaled[i] for i in sorted(journaled) if i not in covered]
+    if len(result_files) > 0 or len(journaled) > 0:
+        # Les fichiers n'ont pas tous la même taille (reprise, plusieurs processus)
+        num_images = len(covered) + len(journaled)
     else:
-        raise ValueError(f"Aucun fichier 'results_*.npy' trouvé dans {args.output_dir}")
+        raise ValueError(f"Aucun fichier 'results_*.npy' ni journal trouvé dans {args.output_dir}")
 
     print(f"Nombre total d'images calculé : {num_images}")
 
     # Chargement des fichiers de résultats
     for file_number, f_name in enumerate(result_files):
         all_data = np.load(f_name)
-        for step in range(args.steps_per_example):
-            all_all_results[step] += all_data[step].tolist()
+        for i in range(len(eval_steps)):
+            all_all_results[i] += all_data[i].tolist()
+    for record in journaled:
+        for i in range(len(eval_steps)):
+            all_all_results[i].append(record['results'][i])
 
     # Indiquer que le modèle est finalisé
     with open(os.path.join(args.output_dir, 'model-final.pth'), 'w') as f:
@@ -477,6 +1792,11 @@ def save_accuracy_results(args):
     # Sauvegarde des résultats d'accuracy
     with open(os.path.join(args.output_dir, 'accuracy.txt'), 'a') as f:
         f.write(f'{str(args)}\n')
-        for i in range(args.steps_per_example):
+        for i, step in enumerate(eval_steps):
             assert len(all_all_results[i]) == num_images, f"Expected {num_images}, but got {len(all_all_results[i])}"
-            f.write(f'{i}\t{np.mean(all_all_results[i])}\n')
+            f.write(f'{step}\t{np.mean(all_all_results[i])}\n')
+        steps_files = glob.glob(os.path.join(args.output_dir, 'steps_*.npy'))
+        journaled_steps = [record['steps'] for record in journaled if record['steps'] is not None]
+        if len(steps_files) > 0 or len(journaled_steps) > 0:
+            all_steps = np.concatenate([np.load(f_name) for f_name in steps_files] + [journaled_steps])
+            f.write(f'steps_per_example\t{np.mean(all_steps)}\n')
@@ -27,28 +27,86 @@ from torchvision import datasets
 import glob
 import util.misc as misc
 import models_mae_shared
-from engine_test_time import train_on_test, get_prameters_from_args, train_on_test_online
+from engine_test_time import train_on_test, get_prameters_from_args, train_on_test_online, train_on_test_batched, train_on_test_grouped, evaluate_stored_latents, \
+    train_on_test_process_pool, shard_examples, merge_sharded_results, online_state_example
 from data import tt_image_folder
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
+from util.journal import ExampleJournal
+from util.result_cache import ResultCache, result_key_parts
 
 
 
 def get_args_parser():
     parser = argparse.ArgumentParser('MAE test time training', add_help=False)
     parser.add_argument('--print_freq', default=50, type=int)
-    parser.add_argument('--finetune_mode', default='encoder', type=str, help='all, encoder, encoder_no_cls_no_msk.')
+    parser.add_argument('--finetune_mode', default='encoder', type=str, help='all, encoder, encoder_no_cls_no_msk, encoder_top_blocks.')
+    parser.add_argument('--finetune_blocks', default=4, type=int,
+                        help='Number of top encoder blocks adapted with finetune_mode encoder_top_blocks.')
     # Model parameters
     parser.add_argument('--model', default='mae_vit_large_patch16', type=str, metavar='MODEL',
                         help='Name of model to train')
     parser.add_argument('--input_size', default=224, type=int,
                         help='images input size')
+    parser.add_argument('--adapt_input_size', default=0, type=int,
+                        help='Input size of the test time training crops (0 for input_size). Classification stays at input_size.')
     parser.add_argument('--classifier_depth', type=int, metavar='N', default=0,
                         help='number of blocks in the classifier')
     # Test time training
     parser.add_argument('--mask_ratio', default=0.75, type=float,
                         help='Masking ratio (percentage of removed patches).')
+    parser.add_argument('--mask_ratio_schedule', default='constant', type=str,
+                        help="Mask ratio of the test time training steps: 'constant' (mask_ratio), 'linear:START:END', 'cosine:START:END', "
+                             "a comma separated list of ratios spread over the steps, or 'flops:TARGET' for the lowest ratio costing "
+                             "at most TARGET times the FLOPs of a step at mask_ratio.")
     parser.add_argument('--steps_per_example', default=1, type=int,help='If online version: the number of steps for every examples after the frist one.')
-    parser.add_argument('--stored_latents', default='', help='have we generated the latents already?')
+    parser.add_argument('--step_budget', default=0, type=float,
+                        help='Average number of steps per example, spread by difficulty up to steps_per_example (0: every example gets steps_per_example).')
+    parser.add_argument('--step_budget_min', default=2, type=int, help='Steps done before the step budget of an example is set.')
+    parser.add_argument('--step_budget_window', default=200, type=int, help='Number of recent examples the difficulty is ranked against.')
+    parser.add_argument('--warm_start_cache', default=0, type=int,
+                        help='Number of adapted weight deltas cached to warm start similar examples (0: every example starts from the base model).')
+    parser.add_argument('--warm_start_threshold', default=0.9, type=float,
+                        help='Cosine similarity of the cls embeddings above which an example starts from a cached delta.')
+    parser.add_argument('--warm_start_steps', default=5, type=int, help='Number of steps of an example that is warm started.')
+    parser.add_argument('--warm_start_density', default=0.05, type=float,
+                        help='Fraction of every cached delta kept, the entries with the largest magnitudes (1: dense deltas).')
+    parser.add_argument('--confidence_gate', default='none', choices=['none', 'max_prob', 'entropy'],
+                        help='Skip the adaptation of the examples the un-adapted model is confident on.')
+    parser.add_argument('--confidence_threshold', default=0.9, type=float,
+                        help='Max probability above which (max_prob), or entropy below which (entropy), an example is skipped.')
+    parser.add_argument('--early_stop', action='store_true',
+                        help='Stop the adaptation of an example once its reconstruction loss has plateaued.')
+    parser.set_defaults(early_stop=False)
+    parser.add_argument('--early_stop_threshold', default=0.01, type=float,
+                        help='Minimal relative improvement of the reconstruction loss that resets the patience.')
+    parser.add_argument('--early_stop_patience', default=2, type=int, help='Number of steps without improvement before stopping.')
+    parser.add_argument('--early_stop_min_steps', default=3, type=int, help='Minimal number of steps per example.')
+    parser.add_argument('--host_sync_free', action='store_true',
+                        help='Keep the per-step losses and predictions on the device and copy them to the host once per example.')
+    parser.set_defaults(host_sync_free=False)
+    parser.add_argument('--step_time_breakdown', action='store_true',
+                        help='Measure the forward, backward and evaluation times of a step on the first example and print them.')
+    parser.add_argument('--eval_schedule', default='all', type=str,
+                        help='Steps after which the adapted model is evaluated: all, final, log, log:N or a comma separated list of steps.')
+    parser.add_argument('--ttt_group_size', default=1, type=int,
+                        help='Adapt one copy of the weights on groups of this many test examples of the same domain, mixing their crops.')
+    parser.add_argument('--group_reference_dir', default='', type=str,
+                        help='Output directory of a per-example run on the same examples, whose accuracy is printed next to the one with groups.')
+    parser.add_argument('--ttt_batch_examples', default=1, type=int,
+                        help='Number of test examples adapted at once, each with its own weights and optimizer state.')
+    parser.add_argument('--share_frozen', action='store_true',
+                        help='Share the modules that are never adapted (decoder, classification head, frozen blocks) between the base and the adapted model.')
+    parser.add_argument('--no_share_frozen', action='store_false', dest='share_frozen')
+    parser.set_defaults(share_frozen=True)
+    parser.add_argument('--frozen_dtype', default='fp32', choices=['fp32', 'bf16'],
+                        help='Storage of the modules shared with share_frozen; the adapted weights stay in fp32.')
+    parser.add_argument('--reset_mode', default='inplace', choices=['inplace', 'reload'],
+                        help='How the model is reset between examples: restore a flat snapshot of the trainable weights in place, '
+                             'or reload the full state dict and rebuild the optimizer.')
+    parser.add_argument('--stored_latents', default='',
+                        help='Directory of the latent store: classify the test images from stored encoder outputs, encoding missing ones.')
+    parser.add_argument('--latent_batch_size', default=256, type=int, help='Batch size for encoding and classifying stored latents.')
+    parser.add_argument('--latent_dtype', default='float32', choices=['float32', 'float16'], help='Storage type of the stored latents.')
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05,
                         help='weight decay (default: 0.05)')
@@ -63,10 +121,17 @@ def get_args_parser():
                         help='dataset name')
     parser.add_argument('--output_dir', default='./output_dir',
                         help='path where to save, empty for no saving')
+    parser.add_argument('--result_cache', default='',
+                        help='Shared directory of results keyed by the arguments, checkpoints and dataset: a completed run '
+                             'with the same key is copied to output_dir instead of being run again, a partial one is resumed.')
     parser.add_argument('--log_dir', default='./output_dir',
                         help='path where to tensorboard log')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='Precision of the forward passes: bf16 runs them under torch.autocast (bf16 on CPU needs AVX512-BF16 or AMX to be fast).')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='Torch intra-op threads (0: the torch default). Ignored with num_processes > 1.')
     parser.add_argument('--accum_iter', default=1, type=int,
                         help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
     parser.add_argument('--load_loss_scalar', action='store_true')
@@ -78,6 +143,10 @@ def get_args_parser():
     parser.add_argument('--resume_model', default='', required=True, help='resume from checkpoint')
     parser.add_argument('--resume_finetune', default='', required=True, help='resume from checkpoint')
     parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--num_processes', default=1, type=int,
+                        help='Number of forked CPU processes sharing the base weights, each adapting a slice of the dataset.')
+    parser.add_argument('--threads_per_process', default=0, type=int,
+                        help='Torch threads of every process with num_processes > 1 (0: the cores split evenly).')
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
@@ -104,12 +173,27 @@ def get_args_parser():
     parser.add_argument('--print_images', action='store_true')
     parser.set_defaults(print_images=False)
     parser.add_argument('--num_print_images', default=5, type=int)
+    parser.add_argument('--print_images_dir', default='', type=str,
+                        help='Directory of the print_images snapshots (default: output_dir/images_evolution).')
+    parser.add_argument('--print_images_queue', default=8, type=int,
+                        help='Snapshots waiting for the writer process; new ones are dropped when it is full.')
     parser.add_argument('--online_ttt', action='store_true',help='Run the online version.')
     parser.set_defaults(online_ttt=False)
     parser.add_argument('--steps_first_example', default=250, type=int, help='The number of steps for the first examples of the online version.')
+    parser.add_argument('--burst_cache', default='', type=str,
+                        help='Directory of the cached states reached by the online warm-up burst, keyed by the checkpoints, '
+                             'the first image and the hyperparameters. Runs that only differ by their seed reuse them.')
     parser.add_argument('--number_of_example_reinitialize', default=-1, type=int, help='The number of example that you want to treat as a single cluster for the online version. If -1 you dont reinitialize the model.')
     parser.add_argument('--reinitialize_first_last_one', action='store_true',help='Run the online version with reintialization of the models weights to the first step of the last example.')
     parser.set_defaults(reinitialize_first_last_one=False)
+    parser.add_argument('--shift_detector', action='store_true',
+                        help='In the online version, reinitialize the model and spend steps_first_example steps only when the stream shifts.')
+    parser.add_argument('--shift_threshold', default=5., type=float,
+                        help='Z-score of the step 0 MAE loss or of the cls feature distance that flags a shift.')
+    parser.add_argument('--shift_window', default=50, type=int, help='Number of recent examples the shift z-scores are computed against.')
+    parser.add_argument('--shift_min_examples', default=30, type=int, help='Minimum number of examples between two shifts.')
+    parser.add_argument('--rollback_depth', default=1, type=int,
+                        help='With reinitialize_first_last_one, roll back to the first step of the rollback_depth-th last example (kept in memory).')
     parser.add_argument('--shuffle', action='store_true',help='Shuffle the dataset for the online version.')
     parser.set_defaults(shuffle=False)
     parser.add_argument('--save_mae_online',action='store_true',help='save the weights of the mae after test training')
@@ -154,7 +238,15 @@ def load_combined_model(args, num_classes: int = 1000):
         loss_scaler = None
     return model, optimizer, loss_scaler
 
+# Arguments that do not change the results of a run, besides those of util.result_cache.
+_RESULT_CACHE_IGNORED_ARGS = ('print_images', 'num_print_images', 'print_images_dir', 'print_images_queue', 'num_processes',
+                              'threads_per_process', 'num_threads', 'reset_mode', 'burst_cache', 'latent_batch_size',
+                              'step_time_breakdown', 'group_reference_dir')
+
+
 def main(args):
+    if args.result_cache:
+        return ResultCache(args.result_cache, result_key_parts(args, _RESULT_CACHE_IGNORED_ARGS)).run(main, args)
     misc.init_distributed_mode(args)
 
     print('job dir: {}'.format(os.path.dirname(os.path.realpath(__file__))))
@@ -167,14 +259,29 @@ def main(args):
     np.random.seed(seed)
 
     cudnn.benchmark = True
+    if args.num_threads > 0 and args.num_processes == 1:
+        torch.set_num_threads(args.num_threads)
     max_known_file = max([int(i.split('results_')[-1].split('.npy')[0]) for i in glob.glob(os.path.join(args.output_dir, 'results_*.npy'))] + [-1])
+    # The journal records every finished example, the results files only every 500 examples.
+    max_known_file = max(max_known_file, ExampleJournal(os.path.join(args.output_dir, 'journal.jsonl')).last_example())
+    if args.online_ttt:
+        # The online model depends on every example before, so the stream resumes from the state saved with the last results files.
+        assert max_known_file == -1 or online_state_example(args) != -1, \
+            f'Found results in {args.output_dir} but no online state to resume the stream from.'
+        max_known_file = online_state_example(args)
     if max_known_file != -1:
         print(f'Found {max_known_file} values, continues from next iterations.')
 
     if args.online_ttt :
         print("Running the online version of TTT.")
+    if args.num_processes > 1 or (args.distributed and not args.online_ttt):
+        # Every process resumes its own slice of the dataset.
+        max_known_file = -1
+        if args.threads_per_process == 0:
+            args.threads_per_process = max(1, os.cpu_count() // args.num_processes)
 
     # simple augmentation
+    adapt_input_size = args.adapt_input_size or args.input_size
     transform_val = transforms.Compose([
             transforms.Resize(256, interpolation=3),
             transforms.CenterCrop(args.input_size),
@@ -182,26 +289,36 @@ def main(args):
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     if not args.single_crop:
         transform_train = transforms.Compose([
-            transforms.RandomResizedCrop(args.input_size, scale=(0.2, 1.0), interpolation=3),  # 3 is bicubic
+            transforms.RandomResizedCrop(adapt_input_size, scale=(0.2, 1.0), interpolation=3),  # 3 is bicubic
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     else:
         transform_train = transforms.Compose([
-            transforms.Resize(256, interpolation=3),
-            transforms.CenterCrop(args.input_size),
+            transforms.Resize(256 * adapt_input_size // args.input_size, interpolation=3),
+            transforms.CenterCrop(adapt_input_size),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
 
     data_path = args.data_path
 
+    if args.stored_latents:
+        dataset_val = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_val,
+                                                          batch_size=1, minimizer=None,
+                                                          single_crop=args.single_crop, start_index=0)
+        model, _, _ = load_combined_model(args, 1000)
+        evaluate_stored_latents(model, dataset_val, device, args)
+        return
+
     if args.online_ttt :
+        # A resumed stream goes on from the saved online state, without a new warm-up burst.
+        online_initial_steps = args.steps_first_example * args.accum_iter if max_known_file == -1 else args.steps_per_example
         if args.shuffle :
             print(f"Shuffling dataset with seed: {args.shuffle_seed}")
             with open(os.path.join(args.output_dir, 'shuffling_seed.txt'), 'w') as f:
                 f.write(f"shuffle_seed: {args.shuffle_seed}\n")
             dataset_train = tt_image_folder.ExtendedImageFolder_online_shuffle(data_path, transform=transform_train,
-                                                        batch_size=args.batch_size, initial_steps = args.steps_first_example * args.accum_iter,subsequent_steps = args.steps_per_example,
+                                                        batch_size=args.batch_size, initial_steps = online_initial_steps,subsequent_steps = args.steps_per_example,
                                                         single_crop=args.single_crop, start_index=max_known_file+1, shuffle_seed=args.shuffle_seed, print_index = True)
 
             shuffled_indices_train = dataset_train.get_shuffled_indices()
@@ -219,17 +336,27 @@ def main(args):
 
             shuffled_indices_val = dataset_val.get_shuffled_indices()
 
+        elif args.shift_detector :
+            # Every example can get a warm-up burst, its crops are loaded one example at a time.
+            dataset_train = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_train, minimizer=None,
+                                                        batch_size=args.batch_size, steps_per_example=max(args.steps_first_example, args.steps_per_example * args.accum_iter),
+                                                        single_crop=args.single_crop, start_index=max_known_file+1)
+
+            dataset_val = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_val,
+                                                            batch_size=1, minimizer=None,
+                                                            single_crop=args.single_crop, start_index=max_known_file+1)
         else :
             dataset_train = tt_image_folder.ExtendedImageFolder_online(data_path, transform=transform_train, minimizer=None,
-                                                        batch_size=args.batch_size, initial_steps = args.steps_first_example * args.accum_iter,subsequent_steps = args.steps_per_example,
+                                                        batch_size=args.batch_size, initial_steps = online_initial_steps,subsequent_steps = args.steps_per_example,
                                                         single_crop=args.single_crop, start_index=max_known_file+1)
 
             dataset_val = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_val,
                                                             batch_size=1, minimizer=None,
                                                             single_crop=args.single_crop, start_index=max_known_file+1)
     else :
+        # With groups, every step mixes batch_size / ttt_group_size crops of each example of the group.
         dataset_train = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_train, minimizer=None,
-                                                        batch_size=args.batch_size, steps_per_example=args.steps_per_example * args.accum_iter,
+                                                        batch_size=-(-args.batch_size // args.ttt_group_size), steps_per_example=args.steps_per_example * args.accum_iter,
                                                         single_crop=args.single_crop, start_index=max_known_file+1)
 
         dataset_val = tt_image_folder.ExtendedImageFolder(data_path, transform=transform_val,
@@ -243,7 +370,8 @@ def main(args):
 
     print("Model = %s" % str(model))
 
-    eff_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
+    # The ranks adapt on different examples, so the batch of every adaptation step does not grow with the world size.
+    eff_batch_size = args.batch_size * args.accum_iter
 
     args.lr = args.blr * eff_batch_size / 256
 
@@ -266,6 +394,49 @@ def main(args):
             num_classes=num_classes,
             iter_start=max_known_file+1
         )
+    elif args.distributed:
+        # Every rank adapts on its own slice of the examples and writes its own results files.
+        iter_start, iter_end = shard_examples(len(dataset_val), misc.get_rank(), misc.get_world_size(), args)
+        print(f'Rank {misc.get_rank()}: examples {iter_start} to {iter_end - 1}', force=True)
+        engine = train_on_test_batched if args.ttt_batch_examples > 1 else train_on_test_grouped if args.ttt_group_size > 1 else train_on_test
+        if iter_start < iter_end:
+            test_stats = engine(
+                model, optimizer, scalar, dataset_train, dataset_val,
+                device,
+                log_writer=None,
+                args=args,
+                num_classes=num_classes,
+                iter_start=iter_start,
+                iter_end=iter_end,
+                merge_results=False
+            )
+        merge_sharded_results(args, misc.get_rank(), misc.get_world_size())
+    elif args.num_processes > 1:
+        train_on_test_process_pool(
+            model, optimizer, scalar, dataset_train, dataset_val,
+            device,
+            log_writer=None,
+            args=args,
+            num_classes=num_classes
+        )
+    elif args.ttt_batch_examples > 1:
+        test_stats = train_on_test_batched(
+            model, optimizer, scalar, dataset_train, dataset_val,
+            device,
+            log_writer=None,
+            args=args,
+            num_classes=num_classes,
+            iter_start=max_known_file+1
+        )
+    elif args.ttt_group_size > 1:
+        test_stats = train_on_test_grouped(
+            model, optimizer, scalar, dataset_train, dataset_val,
+            device,
+            log_writer=None,
+            args=args,
+            num_classes=num_classes,
+            iter_start=max_known_file+1
+        )
     else:
         test_stats = train_on_test(
             model, optimizer, scalar, dataset_train, dataset_val,
@@ -16,7 +16,7 @@ import torch.nn as nn
 
 from timm.models.vision_transformer import PatchEmbed, Block
 
-from util.pos_embed import get_2d_sincos_pos_embed
+from util.pos_embed import get_2d_sincos_pos_embed, resize_pos_embed
 
 
 class MaskedAutoencoderViT(nn.Module):
@@ -43,6 +43,8 @@ class MaskedAutoencoderViT(nn.Module):
             Block(embed_dim, num_heads, mlp_ratio, qkv_bias=True, norm_layer=norm_layer)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
+        # the first num_frozen_blocks blocks (and everything before them) are run without autograd
+        self.num_frozen_blocks = 0
         if self.rotation_prediction:
             self.rotation_head = nn.Linear(decoder_embed_dim, num_classes)
         # --------------------------------------------------------------------------
@@ -87,6 +89,8 @@ class MaskedAutoencoderViT(nn.Module):
         self.criterion = torch.nn.CrossEntropyLoss()
         # --------------------------------------------------------------------------
         self.norm_pix_loss = norm_pix_loss
+        # Fixed sin-cos embeddings interpolated to other input resolutions.
+        self._pos_embed_cache = {}
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -152,6 +156,31 @@ class MaskedAutoencoderViT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], 3, h * p, h * p))
         return imgs
 
+    @staticmethod
+    def num_kept_tokens(num_patches, mask_ratio):
+        """Number of patch tokens seen by the encoder with mask_ratio."""
+        return int(num_patches * (1 - mask_ratio))
+
+    @staticmethod
+    def _blocks_flops(blocks, num_tokens):
+        """Multiply-adds of a forward pass of blocks on num_tokens tokens."""
+        flops = 0
+        for blk in blocks:
+            dim, hidden_dim = blk.attn.qkv.in_features, blk.mlp.fc1.out_features
+            # qkv and output projections, mlp, then attention scores and weighted sum.
+            flops += num_tokens * (4 * dim * dim + 2 * dim * hidden_dim) + 2 * num_tokens * num_tokens * dim
+        return flops
+
+    def forward_flops(self, num_patches, mask_ratio):
+        """
+        Multiply-adds of the transformer blocks of a forward pass of the MAE loss on one image of num_patches patches.
+        The encoder runs on the kept tokens and the decoder on all of them, both with the cls token.
+        """
+        flops = self._blocks_flops(self.blocks, self.num_kept_tokens(num_patches, mask_ratio) + 1)
+        if not self.no_decoder:
+            flops += self._blocks_flops(self.decoder_blocks, num_patches + 1)
+        return flops
+
     def random_masking(self, x, mask_ratio):
         """
         Perform per-sample random masking by per-sample shuffling.
@@ -159,7 +188,7 @@ class MaskedAutoencoderViT(nn.Module):
         x: [N, L, D], sequence
         """
         N, L, D = x.shape  # batch, length, dim
-        len_keep = int(L * (1 - mask_ratio))
+        len_keep = self.num_kept_tokens(L, mask_ratio)
 
         noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
 
@@ -181,16 +210,20 @@ class MaskedAutoencoderViT(nn.Module):
 
     def convert_masking(self, x, input_mask, mask_ratio):
         N, L, D = x.shape  # batch, length, dim
-        len_keep = int(L * (1 - mask_ratio))
-        if not isinstance(input_mask, np.ndarray):
-            input_mask = np.array(input_mask)
-        if len(input_mask.shape) == 1:
-            input_mask = np.expand_dims(input_mask, axis=1)
-        if input_mask.shape[0] != N:
-            assert input_mask.shape[0] == 1
-            input_mask = np.repeat(input_mask, N, axis=0)
-        assert input_mask.shape == (N, L)
-        ids_shuffle = torch.tensor(input_mask, device=x.device, dtype=torch.long)
+        len_keep = self.num_kept_tokens(L, mask_ratio)
+        if torch.is_tensor(input_mask):
+            # Patch orders (ids_shuffle) of the images, e.g. drawn by the caller from its own generator.
+            ids_shuffle = input_mask.to(x.device, torch.long).expand(N, L)
+        else:
+            if not isinstance(input_mask, np.ndarray):
+                input_mask = np.array(input_mask)
+            if len(input_mask.shape) == 1:
+                input_mask = np.expand_dims(input_mask, axis=1)
+            if input_mask.shape[0] != N:
+                assert input_mask.shape[0] == 1
+                input_mask = np.repeat(input_mask, N, axis=0)
+            assert input_mask.shape == (N, L)
+            ids_shuffle = torch.tensor(input_mask, device=x.device, dtype=torch.long)
         ids_restore = torch.argsort(ids_shuffle, dim=1)
 
         # keep the first subset
@@ -206,28 +239,61 @@ class MaskedAutoencoderViT(nn.Module):
         return x_masked, mask, ids_restore
 
 
-    def forward_encoder(self, x, mask_ratio, input_mask=None):
-        # embed patches
-        x = self.patch_embed(x)
+    def embed_patches(self, imgs):
+        """
+        imgs: (N, 3, H, W), with H == W a multiple of the patch size, not necessarily img_size
+        x: (N, L, D)
+        """
+        if tuple(imgs.shape[2:]) == tuple(self.patch_embed.img_size):
+            return self.patch_embed(imgs)
+        p = self.patch_embed.patch_size[0]
+        assert imgs.shape[2] == imgs.shape[3] and imgs.shape[2] % p == 0
+        proj = self.patch_embed.proj
+        x = proj(imgs.to(proj.weight.dtype)).flatten(2).transpose(1, 2)
+        return self.patch_embed.norm(x).to(imgs.dtype)
 
-        # add pos embed w/o cls token
-        x = x + self.pos_embed[:, 1:, :]
+    def resized_pos_embed(self, name, num_patches):
+        """
+        The fixed sin-cos embedding name ('pos_embed' or 'decoder_pos_embed') for num_patches patches.
+        The embeddings are frozen, so their interpolation to each resolution is computed once and cached.
+        """
+        pos_embed = getattr(self, name)
+        if pos_embed.shape[1] == num_patches + 1:
+            return pos_embed
+        key = (name, num_patches, pos_embed.dtype, pos_embed.device)
+        if key not in self._pos_embed_cache:
+            with torch.no_grad():
+                self._pos_embed_cache[key] = resize_pos_embed(pos_embed.detach().float(), int(num_patches ** .5)).to(pos_embed.dtype)
+        return self._pos_embed_cache[key]
 
-        # masking: length -> length * mask_ratio
-        if mask_ratio != 0:
-            if input_mask is None:
-                x, mask, ids_restore = self.random_masking(x, mask_ratio)
+    def forward_encoder(self, x, mask_ratio, input_mask=None):
+        with torch.set_grad_enabled(torch.is_grad_enabled() and self.num_frozen_blocks == 0):
+            # embed patches
+            x = self.embed_patches(x)
+            pos_embed = self.resized_pos_embed('pos_embed', x.shape[1])
+
+            # add pos embed w/o cls token
+            x = x + pos_embed[:, 1:, :]
+
+            # masking: length -> length * mask_ratio
+            if mask_ratio != 0:
+                if input_mask is None:
+                    x, mask, ids_restore = self.random_masking(x, mask_ratio)
+                else:
+                    x, mask, ids_restore = self.convert_masking(x, input_mask, mask_ratio)
             else:
-                x, mask, ids_restore = self.convert_masking(x, input_mask, mask_ratio)
-        else:
-            mask, ids_restore = None, None
-        # append cls token
-        cls_token = self.cls_token + self.pos_embed[:, :1, :]
-        cls_tokens = cls_token.expand(x.shape[0], -1, -1)
-        x = torch.cat((cls_tokens, x), dim=1)
+                mask, ids_restore = None, None
+            # append cls token
+            cls_token = self.cls_token + pos_embed[:, :1, :]
+            cls_tokens = cls_token.expand(x.shape[0], -1, -1)
+            x = torch.cat((cls_tokens, x), dim=1)
+
+            # apply the frozen Transformer blocks
+            for blk in self.blocks[:self.num_frozen_blocks]:
+                x = blk(x)
 
         # apply Transformer blocks
-        for blk in self.blocks:
+        for blk in self.blocks[self.num_frozen_blocks:]:
             x = blk(x)
         x = self.norm(x)
 
@@ -245,7 +311,7 @@ class MaskedAutoencoderViT(nn.Module):
             x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
 
         # add pos embed
-        x = x + self.decoder_pos_embed
+        x = x + self.resized_pos_embed('decoder_pos_embed', x.shape[1] - 1)
 
         # apply Transformer blocks
         for blk in self.decoder_blocks:
@@ -283,7 +349,7 @@ class MaskedAutoencoderViT(nn.Module):
 
     def forward_head(self, latent, target):
         head = self.head(self.bn(latent))
-        loss = self.criterion(head, target) if target.dtype == torch.long else None
+        loss = self.criterion(head, target) if target is not None and target.dtype == torch.long else None
         return head, loss
 
     def forward_vit_head(self, x, target):
@@ -300,7 +366,7 @@ class MaskedAutoencoderViT(nn.Module):
         # predictor projection
         x = x[:, :1, :]
         head = self.classifier_pred(x)[:, 0]
-        loss = self.criterion(head, target) if target.dtype == torch.long else None
+        loss = self.criterion(head, target) if target is not None and target.dtype == torch.long else None
         return head, loss
 
     def forward(self, imgs, target = None, mask_ratio: float = 0.75, input_mask=None, reconstruct=True):
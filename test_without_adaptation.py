@@ -18,6 +18,7 @@ from einops import repeat
 import tqdm
 import os.path
 from data import tt_image_folder
+from util.result_cache import ResultCache, result_key_parts
 
 def get_args_parser():
     parser = argparse.ArgumentParser('MAE testing.', add_help=False)
@@ -47,6 +48,9 @@ def get_args_parser():
     parser.set_defaults(norm_pix_loss=False)
     parser.add_argument('--output_dir', default='./output_dir',
                         help='path where to save, empty for no saving')
+    parser.add_argument('--result_cache', default='',
+                        help='Shared directory of results keyed by the arguments, checkpoints and dataset: a completed run '
+                             'with the same key is copied to output_dir instead of being run again.')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=0, type=int)
@@ -58,6 +62,8 @@ def get_args_parser():
 
 
 def main(args):
+    if args.result_cache:
+        return ResultCache(args.result_cache, result_key_parts(args)).run(main, args)
     transform_val = transforms.Compose([
         transforms.Resize(256, interpolation=3),
         transforms.CenterCrop(args.input_size),
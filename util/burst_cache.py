@@ -0,0 +1,45 @@
+# --------------------------------------------------------
+# Persistent cache of the online warm-up burst
+# --------------------------------------------------------
+
+import hashlib
+import json
+import os
+
+import torch
+
+
+class BurstCache:
+    """
+    On-disk cache of the state reached by the warm-up burst of online test-time training (the adapted weights,
+    the optimizer and loss scaler states, and the results recorded during the burst).
+    An entry lives in root/<key>.pth, where key is the sha256 of everything the burst depends on:
+    the checkpoints, the image it adapts on and the hyperparameters. The parts of the key are kept next to it
+    in root/<key>.json. Entries are written to a temporary file and renamed, so an interrupted run never leaves
+    a partial entry, and concurrent runs computing the same burst just overwrite each other.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(parts):
+        """parts: JSON serializable dict identifying the burst."""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f'{key}.pth')
+
+    def load(self, key, map_location='cpu'):
+        """Returns the cached entry of key, or None."""
+        if not os.path.exists(self._path(key)):
+            return None
+        return torch.load(self._path(key), map_location=map_location)
+
+    def save(self, key, entry, parts=None):
+        tmp_path = self._path(key) + f'.tmp{os.getpid()}'
+        torch.save(entry, tmp_path)
+        os.replace(tmp_path, self._path(key))
+        if parts is not None:
+            with open(os.path.join(self.root, f'{key}.json'), 'w') as f:
+                json.dump(parts, f, sort_keys=True, indent=1)
@@ -0,0 +1,48 @@
+# --------------------------------------------------------
+# Crash-safe journal of per-example test-time training results
+# --------------------------------------------------------
+
+import json
+import os
+
+
+class ExampleJournal:
+    """
+    Append-only journal of the results of every adapted example, one JSON line per example.
+    Every line is written with a single os.write on an O_APPEND descriptor and fsync'd, so the
+    processes of a pool can share the journal and a preempted run loses at most the example in progress.
+    A line truncated by a crash is ignored when the journal is read back.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def append(self, example, results, losses, steps=None, time=None):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        record = {'example': int(example), 'results': [float(r) for r in results],
+                  'losses': [float(l) for l in losses], 'steps': steps, 'time': time}
+        os.write(self._fd, (json.dumps(record) + '\n').encode())
+        os.fsync(self._fd)
+
+    def records(self):
+        """Journaled records by example index. A later record of an example replaces an earlier one."""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['example']] = record
+        return records
+
+    def last_example(self):
+        return max(self.records(), default=-1)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
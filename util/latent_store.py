@@ -0,0 +1,74 @@
+# --------------------------------------------------------
+# Persistent store of encoder outputs for test images
+# --------------------------------------------------------
+
+import json
+import os
+
+import numpy as np
+
+
+class LatentStore:
+    """
+    Memory-mapped store of the encoder outputs (cls token + patch tokens) of test images.
+    A store lives in root/<key>, where key identifies the encoder checkpoint, and its rows are keyed by image path.
+    New images are appended as a new shard; the index is only updated once a shard is completely written,
+    so an interrupted run leaves the store consistent.
+    """
+    def __init__(self, root, key):
+        self.dir = os.path.join(root, key)
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+        else:
+            index = {'shards': [], 'rows': {}}
+        self.shards = index['shards']
+        self.rows = index['rows']
+        self._memmaps = {}
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    def missing(self, paths):
+        return [p for p in paths if p not in self.rows]
+
+    def _shard_path(self, shard):
+        return os.path.join(self.dir, self.shards[shard])
+
+    def add_shard(self, paths, latents, dtype=np.float32):
+        """
+        Writes the latents of paths to a new shard.
+        latents: iterable of [B, 1 + L, D] arrays, in the order of paths.
+        """
+        shard = len(self.shards)
+        file_name = f'latents_{shard}.npy'
+        out = None
+        row = 0
+        for batch in latents:
+            if out is None:
+                out = np.lib.format.open_memmap(os.path.join(self.dir, file_name), mode='w+', dtype=dtype,
+                                                shape=(len(paths),) + tuple(batch.shape[1:]))
+            out[row:row + len(batch)] = batch
+            row += len(batch)
+        assert row == len(paths), f'Expected {len(paths)} latents, got {row}.'
+        out.flush()
+        del out
+        self.shards.append(file_name)
+        for i, p in enumerate(paths):
+            self.rows[p] = [shard, i]
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'shards': self.shards, 'rows': self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, paths):
+        """Returns the stored latents of paths as one [len(paths), 1 + L, D] array."""
+        out = []
+        for p in paths:
+            shard, row = self.rows[p]
+            if shard not in self._memmaps:
+                self._memmaps[shard] = np.load(self._shard_path(shard), mmap_mode='r')
+            out.append(self._memmaps[shard][row])
+        return np.stack(out, axis=0)
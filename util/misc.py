@@ -11,6 +11,7 @@
 
 import builtins
 import datetime
+import hashlib
 import os
 import time
 from collections import defaultdict, deque
@@ -45,7 +46,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda' if torch.cuda.is_available() else 'cpu')
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -251,8 +252,9 @@ def init_distributed_mode(args):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # A disabled scaler is a no-op: backward on the raw loss and a plain optimizer step.
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -343,4 +345,13 @@ def all_reduce_mean(x):
         x_reduce /= world_size
         return x_reduce.item()
     else:
-        return x
\ No newline at end of file
+        return x
+
+
+def file_checksum(path, chunk_size=1 << 24):
+    """sha256 of a file (e.g. a checkpoint), read in chunks."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -75,7 +75,6 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
 def interpolate_pos_embed(model, checkpoint_model):
     if 'pos_embed' in checkpoint_model:
         pos_embed_checkpoint = checkpoint_model['pos_embed']
-        embedding_size = pos_embed_checkpoint.shape[-1]
         num_patches = model.patch_embed.num_patches
         num_extra_tokens = model.pos_embed.shape[-2] - num_patches
         # height (== width) for the checkpoint position embedding
@@ -85,12 +84,22 @@ def interpolate_pos_embed(model, checkpoint_model):
         # class_token and dist_token are kept unchanged
         if orig_size != new_size:
             print("Position interpolate from %dx%d to %dx%d" % (orig_size, orig_size, new_size, new_size))
-            extra_tokens = pos_embed_checkpoint[:, :num_extra_tokens]
-            # only the position tokens are interpolated
-            pos_tokens = pos_embed_checkpoint[:, num_extra_tokens:]
-            pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
-            pos_tokens = torch.nn.functional.interpolate(
-                pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
-            pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
-            new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
-            checkpoint_model['pos_embed'] = new_pos_embed
+            checkpoint_model['pos_embed'] = resize_pos_embed(pos_embed_checkpoint, new_size, num_extra_tokens)
+
+
+def resize_pos_embed(pos_embed, new_size, num_extra_tokens=1):
+    """
+    pos_embed: [1, num_extra_tokens + orig_size*orig_size, D]
+    return: [1, num_extra_tokens + new_size*new_size, D], the position tokens bicubically interpolated
+    """
+    embedding_size = pos_embed.shape[-1]
+    orig_size = int((pos_embed.shape[-2] - num_extra_tokens) ** 0.5)
+    # class_token and dist_token are kept unchanged
+    extra_tokens = pos_embed[:, :num_extra_tokens]
+    # only the position tokens are interpolated
+    pos_tokens = pos_embed[:, num_extra_tokens:]
+    pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
+    pos_tokens = torch.nn.functional.interpolate(
+        pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
+    pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
+    return torch.cat((extra_tokens, pos_tokens), dim=1)
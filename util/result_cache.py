@@ -0,0 +1,140 @@
+# --------------------------------------------------------
+# Content-addressed cache of experiment results
+# --------------------------------------------------------
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+import torch.distributed as dist
+
+from util.misc import file_checksum, is_dist_avail_and_initialized, is_main_process
+
+# Arguments that do not change the results of a run.
+IGNORED_ARGS = ('output_dir', 'log_dir', 'result_cache', 'num_workers', 'pin_mem', 'print_freq', 'verbose',
+                'world_size', 'local_rank', 'dist_on_itp', 'dist_url', 'distributed', 'rank', 'gpu', 'dist_backend')
+
+
+def dataset_fingerprint(root):
+    """sha256 of the relative paths and sizes of the files under root."""
+    sha = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for name in sorted(file_names):
+            path = os.path.join(dir_path, name)
+            sha.update(f'{os.path.relpath(path, root)}\t{os.path.getsize(path)}\n'.encode())
+    return sha.hexdigest()
+
+
+def result_key_parts(args, ignored=()):
+    """The arguments of a run that affect its results, with the checkpoints and the dataset replaced by their hashes."""
+    parts = {k: v for k, v in vars(args).items() if k not in IGNORED_ARGS + tuple(ignored)}
+    for name in ('resume_model', 'resume_finetune'):
+        if parts.get(name):
+            parts[name] = file_checksum(parts[name])
+    parts['data_path'] = dataset_fingerprint(args.data_path)
+    return parts
+
+
+class ResultCache:
+    """
+    Shared directory of run results, keyed by the sha256 of result_key_parts: a run lives in root/<key> and
+    is complete once root/<key>/complete.json is written. A complete entry is copied to the output directory
+    without running anything; an incomplete one is the output directory of the run, so the run resumes from
+    the results it already holds. The run in progress holds root/<key>/running.lock, created exclusively:
+    another run of the same configuration waits for it, and takes the entry over if the holder stops without
+    completing it. A lock left by a dead process of the same host is removed.
+    """
+    def __init__(self, root, parts):
+        self.parts = parts
+        self.key = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+        self.dir = os.path.join(root, self.key)
+        os.makedirs(self.dir, exist_ok=True)
+        self.lock_path = os.path.join(self.dir, 'running.lock')
+
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.dir, 'complete.json'))
+
+    @staticmethod
+    def _lock_owner():
+        """The run taking the lock: all the ranks of a distributed run share its rendezvous address."""
+        if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            return 'job {}:{}'.format(os.environ.get('MASTER_ADDR'), os.environ.get('MASTER_PORT'))
+        return f'process {socket.gethostname()} {os.getpid()}'
+
+    def _acquire(self):
+        """Takes the lock of the entry, returns False while another run holds it."""
+        owner = self._lock_owner()
+        tmp_path = f'{self.lock_path}.{socket.gethostname()}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            f.write(owner)
+        try:
+            # The lock is created with its content: os.link fails if it already exists.
+            os.link(tmp_path, self.lock_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+        try:
+            with open(self.lock_path) as f:
+                holder = f.read()
+        except FileNotFoundError:
+            return False
+        if holder == owner:
+            return True
+        if holder.startswith('process '):
+            host, pid = holder.split()[1:]
+            if host == socket.gethostname() and not _is_alive(int(pid)):
+                print(f'Removing the lock of the dead process {pid} from {self.lock_path}')
+                os.remove(self.lock_path)
+        return False
+
+    def _release(self):
+        if int(os.environ.get('RANK', 0)) == 0 and os.path.exists(self.lock_path):
+            os.remove(self.lock_path)
+
+    def run(self, main, args):
+        """Runs main on args in the cache entry unless it is complete, then copies the entry to args.output_dir.
+        With distributed runs, the entry is only marked complete and copied by the main process, once every rank
+        has finished, and so once the last one has merged the results of all the shards."""
+        waiting = False
+        while not self.is_complete() and not self._acquire():
+            if not waiting:
+                print(f'Waiting for the run holding {self.lock_path}')
+                waiting = True
+            time.sleep(10)
+        if self.is_complete():
+            print(f'Results of this configuration found in {self.dir}')
+        else:
+            print(f'Running in the result cache entry {self.dir}')
+            entry_args = copy.copy(args)
+            entry_args.output_dir = self.dir
+            entry_args.result_cache = ''
+            try:
+                main(entry_args)
+                if is_dist_avail_and_initialized():
+                    dist.barrier()
+                if not is_main_process():
+                    return
+                tmp_path = os.path.join(self.dir, 'complete.json.tmp')
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.parts, f, sort_keys=True, indent=1, default=str)
+                os.replace(tmp_path, os.path.join(self.dir, 'complete.json'))
+            finally:
+                self._release()
+        if args.output_dir:
+            shutil.copytree(self.dir, args.output_dir, dirs_exist_ok=True)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,117 @@
+# --------------------------------------------------------
+# In-place snapshot and restore of model weights
+# --------------------------------------------------------
+
+import torch
+
+
+class ParameterSnapshot:
+    """
+    Pristine copy of a set of parameters, kept in one preallocated flat buffer.
+    The parameters are re-pointed into a single contiguous tensor, so that restore() is one copy_.
+    The model must not be moved to another device after the snapshot is taken.
+    """
+    def __init__(self, parameters, keep_pristine=True):
+        self.parameters = [p for p in parameters]
+        assert len(self.parameters) > 0
+        dtype, device = self.parameters[0].dtype, self.parameters[0].device
+        assert all(p.dtype == dtype and p.device == device for p in self.parameters)
+        self.flat = torch.empty(sum(p.numel() for p in self.parameters), dtype=dtype, device=device)
+        offset = 0
+        for p in self.parameters:
+            numel = p.numel()
+            self.flat[offset:offset + numel].copy_(p.data.reshape(-1))
+            p.data = self.flat[offset:offset + numel].view_as(p)
+            offset += numel
+        # Without a pristine copy, the snapshot only gathers the parameters into flat (see SnapshotRing).
+        self.pristine = self.flat.clone() if keep_pristine else None
+
+    def capture(self):
+        self.pristine.copy_(self.flat)
+
+    def restore(self):
+        self.flat.copy_(self.pristine)
+
+
+def zero_optimizer_state_(optimizer):
+    """
+    Resets the optimizer state in place (SGD momentum, Adam moments and step counts).
+    A zeroed state gives the same updates as a freshly built optimizer.
+    """
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            if torch.is_tensor(value):
+                value.zero_()
+            elif isinstance(value, (int, float)):
+                state[key] = 0
+
+
+class SnapshotRing:
+    """
+    Ring of the last depth in-memory snapshots of the trainable parameters of a model and of its optimizer state.
+    The parameters are the ones gathered by a ParameterSnapshot, so capturing or restoring the weights is one copy_
+    of its flat buffer, and the modules that are never adapted are not copied.
+    The snapshot buffers are allocated on the first captures and then reused, so capture() and restore()
+    are in-place copies without any allocation or disk I/O.
+    """
+    def __init__(self, parameters, depth=1):
+        """parameters: ParameterSnapshot of the trainable parameters."""
+        assert depth >= 1
+        self.parameters = parameters
+        self.depth = depth
+        self.slots = [None] * depth
+        self.num_captured = 0
+
+    @staticmethod
+    def _copy_state(state, slot):
+        """Copies an optimizer state dict into slot, reusing its tensors."""
+        for key, value in state.items():
+            if torch.is_tensor(value):
+                if key in slot and torch.is_tensor(slot[key]) and slot[key].shape == value.shape:
+                    slot[key].copy_(value)
+                else:
+                    slot[key] = value.detach().clone()
+            else:
+                slot[key] = value
+
+    def push(self, flat, optimizer_state):
+        """Adds a capture of flat parameters and of an optimizer state by parameter index, e.g. from latest()."""
+        index = self.num_captured % self.depth
+        if self.slots[index] is None:
+            self.slots[index] = (flat.detach().clone(), {})
+        else:
+            self.slots[index][0].copy_(flat)
+        saved_state = self.slots[index][1]
+        for i in list(saved_state):
+            if i not in optimizer_state:
+                del saved_state[i]
+        for i, state in optimizer_state.items():
+            self._copy_state(state, saved_state.setdefault(i, {}))
+        self.num_captured += 1
+
+    def capture(self, optimizer):
+        params = [p for group in optimizer.param_groups for p in group['params']]
+        self.push(self.parameters.flat, {i: optimizer.state[p] for i, p in enumerate(params) if p in optimizer.state})
+
+    def captures(self):
+        """Flat parameters and optimizer states of the captures kept, from the oldest one, e.g. to save them."""
+        num_kept = min(self.num_captured, self.depth)
+        return [self.slots[(self.num_captured - num_kept + i) % self.depth] for i in range(num_kept)]
+
+    def latest(self):
+        """Flat parameters and optimizer state (by parameter index) of the last capture, e.g. to save it."""
+        assert self.num_captured > 0, 'Nothing was captured.'
+        return self.slots[(self.num_captured - 1) % self.depth]
+
+    def restore(self, optimizer, age=0):
+        """Restores the snapshot captured age captures ago, or the oldest one kept if there are fewer."""
+        assert self.num_captured > 0, 'Nothing was captured.'
+        age = min(age, self.depth - 1, self.num_captured - 1)
+        saved_flat, saved_state = self.slots[(self.num_captured - 1 - age) % self.depth]
+        self.parameters.flat.copy_(saved_flat)
+        params = [p for group in optimizer.param_groups for p in group['params']]
+        for i, p in enumerate(params):
+            if i in saved_state:
+                self._copy_state(saved_state[i], optimizer.state.setdefault(p, {}))
+            else:
+                optimizer.state.pop(p, None)
@@ -0,0 +1,158 @@
+# --------------------------------------------------------
+# Schedules for test-time training
+# --------------------------------------------------------
+
+import collections
+import math
+
+import numpy as np
+
+
+def parse_eval_schedule(schedule, num_steps):
+    """
+    Returns the sorted optimizer steps (0-based) after which the adapted model is evaluated.
+    schedule: 'all', 'final', 'log' or 'log:N' (N log-spaced steps, the first and last included),
+    or a comma separated list of steps.
+    """
+    if schedule == 'all':
+        return list(range(num_steps))
+    if schedule == 'final':
+        return [num_steps - 1]
+    if schedule.startswith('log'):
+        num_points = int(schedule.split(':')[1]) if ':' in schedule else int(math.ceil(math.log2(num_steps))) + 1
+        steps = np.round(np.geomspace(1, num_steps, max(num_points, 1))).astype(int) - 1
+        return sorted(set(steps.tolist()))
+    steps = sorted({int(s) for s in schedule.split(',')})
+    assert all(0 <= s < num_steps for s in steps), f'Evaluation steps should be in [0, {num_steps}).'
+    return steps
+
+
+def parse_mask_ratio_schedule(schedule, num_steps, mask_ratio):
+    """
+    Returns the MAE mask ratio of every optimizer step.
+    schedule: 'constant' (mask_ratio at every step), 'linear:START:END' or 'cosine:START:END' (from START at the
+    first step to END at the last one), or a comma separated list of ratios, each used for an equal share of the steps.
+    """
+    if schedule == 'constant':
+        return [mask_ratio] * num_steps
+    if schedule.startswith(('linear:', 'cosine:')):
+        kind, start, end = schedule.split(':')
+        start, end = float(start), float(end)
+        progress = np.linspace(0, 1, num_steps) if num_steps > 1 else np.ones(1)
+        if kind == 'cosine':
+            progress = (1 - np.cos(np.pi * progress)) / 2
+        ratios = (start + (end - start) * progress).tolist()
+    else:
+        values = [float(r) for r in schedule.split(',')]
+        ratios = [values[step * len(values) // num_steps] for step in range(num_steps)]
+    assert all(0 < r < 1 for r in ratios), 'Mask ratios should be in (0, 1).'
+    return ratios
+
+
+class EarlyStopping:
+    """
+    Stops the adaptation of an example once its MAE loss has not improved by more than
+    `threshold` (relative to the best loss so far) for `patience` consecutive steps.
+    At least `min_steps` steps are always done.
+    """
+    def __init__(self, threshold=0.01, patience=2, min_steps=1):
+        self.threshold = threshold
+        self.patience = patience
+        self.min_steps = min_steps
+        self.reset()
+
+    def reset(self):
+        self.best = float('inf')
+        self.num_steps = 0
+        self.num_bad_steps = 0
+
+    def step(self, loss):
+        """Records the loss of a step, returns True if the adaptation should stop."""
+        self.num_steps += 1
+        if loss < self.best * (1 - self.threshold):
+            self.best = loss
+            self.num_bad_steps = 0
+        else:
+            self.num_bad_steps += 1
+        return self.num_steps >= self.min_steps and self.num_bad_steps >= self.patience
+
+
+class ShiftDetector:
+    """
+    Flags a distribution shift in an online stream from two signals measured on every example before it is
+    adapted: the MAE loss and the encoder cls feature. A shift is flagged when the z-score of the loss, or of the
+    cosine distance of the feature to the mean feature, against the last `window` examples exceeds `threshold`.
+    At least `min_examples` examples since the last shift are needed to flag a new one.
+    """
+    def __init__(self, threshold=5., window=50, min_examples=30):
+        self.threshold = threshold
+        self.window = window
+        self.min_examples = min_examples
+        self.reset()
+
+    def reset(self):
+        self.losses = collections.deque(maxlen=self.window)
+        self.features = collections.deque(maxlen=self.window)
+
+    def scores(self, loss, feature):
+        """Z-scores of the loss and of the feature distance of an example against the window."""
+        losses = np.array(self.losses)
+        features = np.stack(self.features)
+        center = features.mean(axis=0)
+        center /= np.linalg.norm(center) + 1e-8
+        distances = 1 - features @ center
+        loss_score = abs(loss - losses.mean()) / (losses.std() + 1e-8)
+        feature_score = (1 - feature @ center - distances.mean()) / (distances.std() + 1e-8)
+        return loss_score, feature_score
+
+    def step(self, loss, feature):
+        """Records the signals of an example, returns True if the stream shifted before it."""
+        feature = np.asarray(feature, dtype=np.float64)
+        feature = feature / (np.linalg.norm(feature) + 1e-8)
+        if len(self.losses) >= self.min_examples and max(self.scores(loss, feature)) > self.threshold:
+            # The examples after the shift are measured on the reset model, so the window starts again.
+            self.reset()
+            return True
+        self.losses.append(loss)
+        self.features.append(feature)
+        return False
+
+
+class StepBudget:
+    """
+    Gives every example a number of optimizer steps out of a global budget of `target` steps per example on average.
+    After its first `min_steps` steps, an example is scored on three difficulty signals: its step-0 MAE loss,
+    the entropy of its un-adapted prediction and the relative decrease of its loss over those steps.
+    The z-scores of the signals against the last `window` examples are summed, and the rank of the score among
+    these examples sets the number of steps linearly between min_steps and 2 * target - min_steps.
+    The steps left unspent, or overspent, by the previous examples are carried over to keep the average at target:
+    record() gives the number of steps an example actually ran, which can be fewer than allocated.
+    """
+    def __init__(self, target, min_steps=2, max_steps=None, window=200, min_history=10):
+        assert min_steps <= target, 'The target number of steps should be at least min_steps.'
+        self.target = target
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.min_history = min_history
+        self.signals = collections.deque(maxlen=window)
+        self.num_examples = 0
+        self.num_steps = 0
+
+    def allocate(self, first_loss, probe_loss, entropy):
+        """Number of steps of an example, given the signals measured after its first min_steps steps."""
+        signals = np.array([first_loss, entropy, (first_loss - probe_loss) / max(abs(first_loss), 1e-8)])
+        rank = 0.5
+        if len(self.signals) >= self.min_history:
+            history = np.stack(self.signals)
+            mean, std = history.mean(axis=0), history.std(axis=0) + 1e-8
+            scores = ((history - mean) / std).sum(axis=1)
+            rank = ((scores < ((signals - mean) / std).sum()).sum() + 0.5) / (len(scores) + 1)
+        self.signals.append(signals)
+        num_steps = self.min_steps + 2 * (self.target - self.min_steps) * rank
+        num_steps += self.target * self.num_examples - self.num_steps
+        return int(round(np.clip(num_steps, self.min_steps, self.max_steps or np.inf)))
+
+    def record(self, num_steps):
+        """Records the number of steps an example ran."""
+        self.num_examples += 1
+        self.num_steps += num_steps
@@ -0,0 +1,74 @@
+# --------------------------------------------------------
+# Warm-start cache of adapted weights
+# --------------------------------------------------------
+
+import collections
+
+import torch
+
+
+class WarmStartCache:
+    """
+    Bounded cache of adapted weight deltas (adapted minus base weights of the trainable parameters),
+    keyed by the cls embedding of the un-adapted encoder on the test image, with LRU eviction.
+    A new example starts from the delta of its nearest cached example if their cosine similarity is at least
+    `threshold`. Only the `density` fraction of the delta with the largest magnitudes is kept (top-k), as int32
+    indices and `dtype` values on `device`: host memory by default, pinned when the weights are on cuda so that
+    a hit is copied back asynchronously. The keys stay on the device of the model.
+    The buffers are allocated by the first `capacity` examples, then the evicted entry's ones are reused.
+    """
+    def __init__(self, capacity, threshold=0.9, density=0.05, dtype=torch.bfloat16, device='cpu'):
+        assert capacity > 0 and 0 < density <= 1
+        self.capacity = capacity
+        self.threshold = threshold
+        self.density = density
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self.entries = collections.OrderedDict()
+        self.num_added = 0
+        self.magnitudes = None
+
+    def lookup(self, key):
+        """Returns (delta, similarity) of the nearest cached example, or (None, similarity) on a miss.
+        The delta is the (indices, values) pair that add_delta_ applies."""
+        if len(self.entries) == 0:
+            return None, float('nan')
+        key = torch.nn.functional.normalize(key.float(), dim=0)
+        ids = list(self.entries)
+        similarities = torch.stack([self.entries[i][0] for i in ids]) @ key
+        best = int(similarities.argmax())
+        similarity = similarities[best].item()
+        if similarity < self.threshold:
+            return None, similarity
+        self.entries.move_to_end(ids[best])
+        return self.entries[ids[best]][1:], similarity
+
+    @staticmethod
+    def add_delta_(flat, delta):
+        """Adds a delta returned by lookup to the flat trainable weights."""
+        indices, values = delta
+        flat.index_add_(0, indices.to(flat.device, torch.long, non_blocking=True),
+                        values.to(flat.device, non_blocking=True).to(flat.dtype))
+
+    def add(self, key, flat, pristine):
+        """Caches the delta flat - pristine of an example, computed in a buffer allocated once."""
+        if self.magnitudes is None:
+            self.magnitudes = torch.empty_like(flat)
+        torch.sub(flat, pristine, out=self.magnitudes).abs_()
+        num_kept = max(1, int(self.density * flat.numel()))
+        _, indices = torch.topk(self.magnitudes, num_kept, sorted=False)
+        if len(self.entries) == self.capacity:
+            _, (_, stored_indices, stored_values) = self.entries.popitem(last=False)
+        else:
+            pin_memory = self.device.type == 'cpu' and flat.is_cuda
+            stored_indices = torch.empty(num_kept, dtype=torch.int32, device=self.device, pin_memory=pin_memory)
+            stored_values = torch.empty(num_kept, dtype=self.dtype, device=self.device, pin_memory=pin_memory)
+        # The signed values are gathered again at the kept indices.
+        stored_values.copy_(flat.gather(0, indices) - pristine.gather(0, indices))
+        stored_indices.copy_(indices)
+        self.entries[self.num_added] = (torch.nn.functional.normalize(key.float(), dim=0), stored_indices, stored_values)
+        self.num_added += 1
+
+    def memory_bytes(self):
+        """Memory used by the cached deltas."""
+        return sum(t.numel() * t.element_size() for _, indices, values in self.entries.values() for t in (indices, values))
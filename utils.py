@@ -1,6 +1,8 @@
 #Utils 
 import matplotlib.pyplot as plt
 import os
+import queue
+import torch.multiprocessing as mp
 
 # def display_images(original, masked, reconstructed,save_dir,file_name,rec_loss,class_loss,step_iteration):
 #     if not os.path.exists(save_dir):
@@ -86,4 +88,45 @@ def apply_mask_to_image(image, mask, patch_size):
     image_patches = image_patches.view(C, H // patch_size, W // patch_size, patch_size, patch_size)
     image_reconstructed = image_patches.permute(0, 1, 3, 2, 4).contiguous().view(C, H, W)
     
-    return image_reconstructed
\ No newline at end of file
+    return image_reconstructed
+
+
+def _image_writer_worker(images_queue, save_dir, patch_size):
+    plt.switch_backend('agg')
+    while True:
+        item = images_queue.get()
+        if item is None:
+            break
+        file_name, original, mask, reconstructions, rec_losses, class_losses, steps = item
+        masked_image = apply_mask_to_image(original, mask, patch_size)
+        # Only the patches reconstructed from the masked ones are shown.
+        reconstructed_imgs = [apply_mask_to_image(reconstructed, 1 - reconstructed_mask, patch_size)
+                              for reconstructed, reconstructed_mask in reconstructions]
+        display_images(original, masked_image, reconstructed_imgs, save_dir, file_name, rec_losses, class_losses, steps)
+
+
+class AsyncImageWriter:
+    """
+    Renders the reconstruction snapshots of display_images in a background process.
+    The training loop only submits detached CPU tensors and losses; when the bounded queue is full
+    the snapshot is dropped, so the visualization never slows down the adaptation.
+    """
+    def __init__(self, save_dir, patch_size, max_queue=8):
+        context = mp.get_context('spawn')
+        self.queue = context.Queue(maxsize=max_queue)
+        self.process = context.Process(target=_image_writer_worker, args=(self.queue, save_dir, patch_size), daemon=True)
+        self.process.start()
+        self.num_dropped = 0
+
+    def submit(self, file_name, original, mask, reconstructions, rec_losses, class_losses, steps):
+        """reconstructions: list of (unpatchified reconstruction, mask) CPU tensors at every step of steps."""
+        try:
+            self.queue.put_nowait((file_name, original, mask, reconstructions, rec_losses, class_losses, steps))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join()
+        if self.num_dropped > 0:
+            print(f'{self.num_dropped} image snapshots were dropped, the writer queue was full.')